@@ -1,16 +1,29 @@
 import sys, os, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 import numpy as np
-import os
+import os, datetime, zipfile
 
-def load_formatted_data(filename):
+from NSI import profiling
+from NSI.epochs import Epoch_Table, network_state_epochs
+
+# arrays with less elements are always loaded in memory (time steps, parameters, ...)
+LAZY_MIN_SIZE = 1000
+
+@profiling.profiled('loading')
+def load_formatted_data(filename, lazy=False):
+    """
+    loads a datafile as a "data" dictionary with the recorded channels listed in data['Channel_Keys']
+
+    with lazy=True the channels are not loaded in memory: they are memory-mapped (.npz, .abf)
+    or kept as h5py datasets (.h5), and only the samples of the slices taken from them are read
+    """
     
     print('Opening: ', filename)
 
     # -----------------------------
     # NPZ file
     if filename.endswith('.npz'):
-        data = dict(np.load(filename))
+        data = load_npz_lazy(filename) if lazy else dict(np.load(filename))
         data['Channel_Keys'] = []
         for key in data.keys():
             if key not in ['dt', 'params', 't', 'Channel_Keys']:
@@ -19,13 +32,13 @@ def load_formatted_data(filename):
     # -----------------------------
     # ABF file (from pClamp recording software, Axon Instruments / Molecular Device)
     elif filename.endswith('.abf'):
-        data = load_axon_file(filename)
+        data = load_axon_file(filename, lazy=lazy)
         print(data)
         
     # -----------------------------
     # HDF5 file (from RTXI, custom softwares, etc..)
     elif filename.endswith('.h5'):
-        data = load_dict_from_hdf5(filename)
+        data = load_dict_from_hdf5(filename, lazy=lazy)
         data['Channel_Keys'] = []
         for key in data.keys():
             if key not in ['dt', 'params', 't', 'Channel_Keys']:
@@ -38,6 +51,68 @@ def load_formatted_data(filename):
         data = {}
     return data
 
+"""
+Numpy format (lazy loading)
+"""
+
+def read_npy_header(f):
+    """
+    shape, fortran order and dtype of the .npy array starting at the current position of the file f
+    """
+    if np.lib.format.read_magic(f)==(1,0):
+        return np.lib.format.read_array_header_1_0(f)
+    else:
+        return np.lib.format.read_array_header_2_0(f)
+
+class Deferred_Array:
+    """
+    array of a compressed .npz member: shape and dtype are read from its header,
+    the array itself is decompressed (once) at the first access to its values
+    """
+    def __init__(self, filename, key):
+        self.filename, self.key, self.values = filename, key, None
+        with zipfile.ZipFile(filename) as zf, zf.open(key+'.npy') as f:
+            self.shape, fortran_order, self.dtype = read_npy_header(f)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.values is None:
+            with np.load(self.filename) as npz:
+                self.values = npz[self.key]
+        return self.values[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+def load_npz_lazy(filename):
+    """
+    members of a .npz file without loading them:
+    uncompressed members are memory-mapped, compressed members are deferred (see Deferred_Array)
+    and small members are loaded
+    """
+    data = {}
+    with np.load(filename) as npz, zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            key = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type!=zipfile.ZIP_STORED:
+                array = Deferred_Array(filename, key)
+                data[key] = array if np.prod(array.shape)>=LAZY_MIN_SIZE else npz[key]
+                continue
+            # position of the array in the file: after the zip local header and the npy header
+            f.seek(info.header_offset+26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset+30+int(name_length)+int(extra_length))
+            shape, fortran_order, dtype = read_npy_header(f)
+            if (np.prod(shape)<LAZY_MIN_SIZE) or dtype.hasobject:
+                data[key] = npz[key]
+            else:
+                data[key] = np.memmap(filename, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                      order=('F' if fortran_order else 'C'))
+    return data
+
 """
 HDF5 format
 ---> also used for the data output !
@@ -78,23 +153,101 @@ def recursively_save_dict_contents_to_group(h5file, path, dic):
         else:
             raise ValueError('Cannot save %s type'%type(item))
 
-def load_dict_from_hdf5(filename):
+def NSI_results_filename(filename):
     """
-    ....
+    output file of the analysis of a datafile: [datafile-root]_NSI_[date]_[time].h5
+    """
+    results_filename = '.'.join(filename.split('.')[:-1]) if '.' in filename else filename
+    return results_filename+'_NSI_'+datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')+'.h5'
+
+# time series of the analysis stored in the "timeseries" group of the output
+NSI_TIMESERIES = ['pLFP', 'sliding_mean', 'max_low_freqs_power', 'NSI', 'NSI_validated', 'NSI_unvalidated']
+
+def save_NSI_results(data, filename, params={}):
+    """
+    saves the sample times of validated network states and their associated NSI level,
+    together with the full time series of the analysis (see write_NSI_timeseries)
+    and the table of network-state epochs in the "epochs" group (see epochs.network_state_epochs)
+    """
+    to_save = {'validated_times': data['new_t'][data['NSI_validated']],
+               'validated_NSI':data['NSI'][data['NSI_validated']],
+               'epochs':(data['epochs'] if 'epochs' in data else network_state_epochs(data)).to_dict()}
+    save_dict_to_hdf5(to_save, filename)
+    with h5py.File(filename, 'a') as h5file:
+        write_NSI_timeseries(h5file, data, params=params)
+
+def write_NSI_timeseries(h5file, data, params={},
+                         chunk_duration=60.,
+                         index_step=1.):
+    """
+    writes the time series of the analysis (at the pLFP resolution) in the "timeseries" group:
+    - as chunked (chunk_duration seconds), compressed datasets,
+    - with the analysis parameters (and new_dt, p0) as attributes,
+    - with a coarse "time_index" dataset of (time, sample index) pairs every index_step seconds
+
+    so that a time window can be read without touching more than a few chunks (see load_NSI_window)
+    """
+    group = h5file.create_group('timeseries')
+    n = len(data['new_t'])
+    chunk = max([1, min([n, int(chunk_duration/data['new_dt'])])])
+    for key in NSI_TIMESERIES:
+        if key in data:
+            group.create_dataset(key, data=np.asarray(data[key]), chunks=(chunk,),
+                                 compression='gzip', compression_opts=4, shuffle=True)
+    istep = max([1, int(index_step/data['new_dt'])])
+    group.create_dataset('time_index', data=np.array([data['new_t'][::istep], np.arange(n)[::istep]]).T)
+
+    group.attrs['new_dt'], group.attrs['p0'], group.attrs['n_samples'] = data['new_dt'], data['p0'], n
+    for key, value in params.items():
+        try:
+            group.attrs[key] = value
+        except TypeError:
+            print('parameter "%s" not stored (type %s)' % (key, type(value)))
+
+def load_NSI_window(filename, t0, t1, keys=NSI_TIMESERIES):
+    """
+    time series of the analysis for new_t in [t0, t1] (read from the "timeseries" group of an output file)
     """
+    with h5py.File(filename, 'r') as h5file:
+        group = h5file['timeseries']
+        time_index, new_dt = group['time_index'][()], group.attrs['new_dt']
+        # closest index entries, then exact bounds at the pLFP resolution
+        i0 = max([0, np.searchsorted(time_index[:,0], t0, side='right')-1])
+        i1 = max([0, np.searchsorted(time_index[:,0], t1, side='right')-1])
+        start = int(time_index[i0,1])+max([0, int(np.ceil((t0-time_index[i0,0])/new_dt-1e-6))])
+        stop = int(time_index[i1,1])+int(np.floor((t1-time_index[i1,0])/new_dt+1e-6))+1
+        stop = max([start, min([stop, int(group.attrs['n_samples'])])]) # (empty window outside of the recording)
+        window = {'new_t':time_index[0,0]+np.arange(start, stop)*new_dt}
+        for key in keys:
+            if key in group:
+                window[key] = group[key][start:stop]
+    return window
+    
+def load_NSI_epochs(filename):
+    """table of network-state epochs of an output file (see epochs.Epoch_Table)"""
+    with h5py.File(filename, 'r') as h5file:
+        return Epoch_Table.from_dict(recursively_load_dict_contents_from_group(h5file, '/epochs/'))
+
+def load_dict_from_hdf5(filename, lazy=False):
+    """
+    with lazy=True, the large datasets are returned as (unread) h5py datasets,
+    the file stays open as long as they are referenced
+    """
+    if lazy:
+        return recursively_load_dict_contents_from_group(h5py.File(filename, 'r'), '/', lazy=True)
     with h5py.File(filename, 'r') as h5file:
         return recursively_load_dict_contents_from_group(h5file, '/')
 
-def recursively_load_dict_contents_from_group(h5file, path):
+def recursively_load_dict_contents_from_group(h5file, path, lazy=False):
     """
     ....
     """
     ans = {}
     for key, item in h5file[path].items():
         if isinstance(item, h5py._hl.dataset.Dataset):
-            ans[key] = item.value
+            ans[key] = item if (lazy and item.size>=LAZY_MIN_SIZE) else item[()]
         elif isinstance(item, h5py._hl.group.Group):
-            ans[key] = recursively_load_dict_contents_from_group(h5file, path + key + '/')
+            ans[key] = recursively_load_dict_contents_from_group(h5file, path + key + '/', lazy=lazy)
     return ans
 
 
@@ -103,17 +256,45 @@ Axon Instruments format
 """
 import pyabf
 
-def load_axon_file(filename, zoom=[0,np.inf]):
+class ABF_Channel:
+    """
+    first sweep of a channel of an ABF file, memory-mapped:
+    only the samples of the slices taken from it are read (and scaled as in pyabf)
+    """
+    def __init__(self, abf, channel):
+        raw = np.memmap(abf.abfFilePath, dtype=abf._dtype, mode='r', offset=abf.dataByteStart,
+                        shape=(int(abf.dataPointCount/abf.channelCount), abf.channelCount))
+        self.raw = raw[:abf.sweepPointCount, channel] # interleaved channels
+        self.scaled = (abf._dtype==np.int16)
+        self.gain, self.offset = abf._dataGain[channel], abf._dataOffset[channel]
+        self.shape, self.dtype, self.ndim = self.raw.shape, np.dtype(np.float32), 1
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        values = np.array(self.raw[index], dtype=np.float32)
+        if self.scaled:
+            values = np.add(np.multiply(values, self.gain), self.offset)
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+def load_axon_file(filename, zoom=[0,np.inf], lazy=False):
 
     try:
-        abf = pyabf.ABF(filename)
+        abf = pyabf.ABF(filename, loadData=(not lazy))
         channels = abf.adcNames
         formatted_data = {'Channel_Keys':channels}
         formatted_data['dt'] = 1./abf.dataRate
 
         for i, channel in enumerate(channels):
-            abf.setSweep(sweepNumber=0, channel=i)
-            formatted_data[channel] = abf.sweepY
+            if lazy:
+                formatted_data[channel] = ABF_Channel(abf, i)
+            else:
+                abf.setSweep(sweepNumber=0, channel=i)
+                formatted_data[channel] = abf.sweepY
 
         return formatted_data
     
@@ -1,14 +1,27 @@
 import sys, argparse
-from PyQt5 import QtGui, QtWidgets, QtCore
-from . import gui
 
-parser=argparse.ArgumentParser(description="Network State Index software",
-                               formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('-f', "--filename", type=str, default='')
-args = parser.parse_args()
-                
-app = QtWidgets.QApplication(sys.argv)
-main = gui.Window(app, datafile=args.filename)
-sys.exit(app.exec_())
+def main():
+
+    # headless batch analysis: "python -m NSI batch [...]"
+    if (len(sys.argv)>1) and (sys.argv[1]=='batch'):
+        from .batch import main as batch_main
+        return batch_main(sys.argv[2:])
+    # performance benchmarks: "python -m NSI benchmark [...]"
+    if (len(sys.argv)>1) and (sys.argv[1]=='benchmark'):
+        from .benchmark import main as benchmark_main
+        return benchmark_main(sys.argv[2:])
+    
+    from PyQt5 import QtGui, QtWidgets, QtCore
+    from . import gui
 
+    parser=argparse.ArgumentParser(description="Network State Index software",
+                                   formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-f', "--filename", type=str, default='')
+    args = parser.parse_args()
+                
+    app = QtWidgets.QApplication(sys.argv)
+    main = gui.Window(app, datafile=args.filename)
+    sys.exit(app.exec_())
 
+if __name__=='__main__':
+    sys.exit(main()) # (number of regressions for "benchmark --compare")
@@ -0,0 +1,140 @@
+"""
+Headless batch analysis of recordings, run with:
+
+python -m NSI batch "data/*.abf" "data/*.h5" --workers 8 --alpha 2.85
+"""
+import sys, os, pathlib, glob, time, json
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from NSI.functions import DEFAULT_VALUES, analyze_with_params, kernel_cache_info
+from NSI.IO import load_formatted_data, NSI_results_filename, save_NSI_results
+from NSI.cache import pLFP_Cache, DEFAULT_FOLDER
+from NSI import profiling
+
+EXTENSIONS = ['.abf', '.h5', '.npz']
+NOT_IN_CLI = ['p0_percentile'] # GUI parameters not used by the analysis (see functions.arguments_from_params)
+
+def find_datafiles(patterns):
+    """
+    datafiles (with a supported extension) matching the glob patterns, without the NSI outputs
+    """
+    filenames = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern, recursive=True)):
+            if (os.path.splitext(filename)[1] in EXTENSIONS) and ('_NSI_' not in filename)\
+               and (filename not in filenames):
+                filenames.append(filename)
+    return filenames
+
+def analyze_file(filename, params=DEFAULT_VALUES, channel='', cache_folder='', threads=1, profile=''):
+    """
+    loads, analyzes and saves the NSI of a single datafile (executed in the worker processes)
+
+    the pLFP is looked up in the cache stored in "cache_folder" (if given),
+    the wavelet transforms run over "threads" threads
+
+    returns a summary of the run: output file, number of samples and wall time,
+    and the per-stage profile if profile='time' or 'memory' (see profiling.Profiler)
+    """
+    if profile in ['time', 'memory']:
+        with profiling.Profiler(memory=(profile=='memory')) as profiler:
+            summary = analyze_file(filename, params, channel, cache_folder, threads)
+        summary['profile'] = profiler.report()
+        return summary
+
+    tstart = time.time()
+    data = load_formatted_data(filename, lazy=True) # only the analyzed channel is read (by chunks)
+    Vext_key = channel if channel!='' else data['Channel_Keys'][0] # first key by default
+    if 'dt' not in data:
+        data['dt'] = 1e-3/params['acq_freq_kHz']
+    if 'gain' not in data:
+        data['gain'] = 1e3*params['gain_mVpV']
+    analyze_with_params(data, Vext_key, params,
+                        cache=(pLFP_Cache(cache_folder) if cache_folder!='' else None),
+                        chunk_duration=60., workers=threads)
+    results_filename = NSI_results_filename(filename)
+    with profiling.stage('saving'):
+        save_NSI_results(data, results_filename, params=params)
+    return {'filename':filename,
+            'results_filename':results_filename,
+            'channel':Vext_key,
+            'n_samples':len(data[Vext_key]),
+            'duration':len(data[Vext_key])*data['dt'],
+            'wall_time':time.time()-tstart,
+            'kernel_cache':kernel_cache_info()} # hits accumulate over the files of a worker process
+
+def run_batch(filenames, params=DEFAULT_VALUES, channel='', workers=1, cache_folder='', threads=1, profile=''):
+    """
+    analyzes all files over a process pool of "workers" processes (of "threads" threads each),
+    returns the list of run summaries (see analyze_file), failed files have an "error" entry
+    """
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_file, filename, params, channel, cache_folder, threads, profile):filename for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+                summary['throughput'] = summary['n_samples']/summary['wall_time']
+                print(' - %s: %.1fs, %.2e samples/s (%.1fx real-time) --> %s' % (summary['filename'],
+                                                                                summary['wall_time'],
+                                                                                summary['throughput'],
+                                                                                summary['duration']/summary['wall_time'],
+                                                                                summary['results_filename']))
+                if 'profile' in summary:
+                    print(profiling.summary(summary['profile']))
+            except Exception as e: # we don't want to stop the whole batch for a single file
+                summary = {'filename':futures[future], 'error':repr(e)}
+                print(' - %s: /!\\ analysis failed: %s' % (futures[future], repr(e)))
+            summaries.append(summary)
+    return summaries
+
+def main(argv=None):
+
+    import argparse
+    parser=argparse.ArgumentParser(description="Batch analysis of the Network State Index",
+                                   formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('patterns', nargs='+', type=str,
+                        help='glob patterns of the datafiles (%s), e.g. "data/**/*.abf"' % ', '.join(EXTENSIONS))
+    parser.add_argument('-w', "--workers", type=int, default=os.cpu_count())
+    parser.add_argument('-t', "--threads", type=int, default=1,
+                        help='threads per worker for the wavelet transforms (e.g. -w 1 -t 32 for a single long file)')
+    parser.add_argument('-c', "--channel", type=str, default='',
+                        help='channel to analyze (first channel by default)')
+    parser.add_argument("--cache", type=str, default='',
+                        help='folder of the pLFP cache (no cache by default), e.g. %s' % DEFAULT_FOLDER)
+    parser.add_argument("--report", type=str, default='',
+                        help='json file where to store the per-file wall times and throughputs (and profiles)')
+    parser.add_argument("--profile", type=str, default='', choices=['', 'time', 'memory'],
+                        help='per-stage profile of each file: wall and cpu times ("time"),\n'+\
+                        'and memory allocations ("memory", slower)')
+    for key, value in DEFAULT_VALUES.items(): # analysis parameters
+        if (type(value) in [int, float]) and (key not in NOT_IN_CLI):
+            parser.add_argument('--'+key, type=float, default=value)
+    args = parser.parse_args(argv)
+
+    params = dict(DEFAULT_VALUES)
+    for key in params:
+        if hasattr(args, key):
+            params[key] = getattr(args, key)
+
+    filenames = find_datafiles(args.patterns)
+    print('Analyzing %i files with %i workers [...]' % (len(filenames), args.workers))
+    tstart = time.time()
+    summaries = run_batch(filenames, params=params, channel=args.channel, workers=args.workers,
+                          cache_folder=args.cache, threads=args.threads, profile=args.profile)
+    total_time = time.time()-tstart
+
+    succeeded = [s for s in summaries if 'error' not in s]
+    print('%i/%i files analyzed in %.1fs, total throughput: %.2e samples/s' % (len(succeeded), len(summaries),
+                                                                                total_time,
+                                                                                np.sum([s['n_samples'] for s in succeeded])/total_time))
+    if args.report!='':
+        with open(args.report, 'w') as f:
+            json.dump({'params':params, 'workers':args.workers, 'threads':args.threads,
+                       'total_time':total_time, 'files':summaries}, f, indent=2)
+
+
+if __name__=='__main__':
+    main()
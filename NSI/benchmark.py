@@ -0,0 +1,229 @@
+"""
+Performance benchmarks of the NSI analysis on synthetic recordings, run with:
+
+python -m NSI benchmark --durations 10 60 300 --output benchmark.json
+python -m NSI benchmark --compare benchmark.json # flags the cases slower than a previous run
+
+each case runs in a fresh process, so that its peak memory (RSS) is measured independently
+"""
+import sys, os, pathlib, time, json, platform, datetime, tempfile, resource
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+import scipy
+from concurrent.futures import ProcessPoolExecutor
+
+from NSI import functions
+from NSI.parallel import shared_multichannel_Network_State_Index
+from NSI.IO import load_formatted_data, save_dict_to_hdf5
+
+BENCHMARKS = ['my_cwt', 'my_cwt_envelope', 'preprocess_LFP', 'preprocess_LFP_chunked',
+              'compute_Network_State_Index', 'Validate_Network_States',
+              'multichannel_Network_State_Index', 'shared_multichannel_Network_State_Index',
+              'load_npz', 'load_h5']
+MULTICHANNEL = ['multichannel_Network_State_Index', 'shared_multichannel_Network_State_Index', 'load_npz', 'load_h5']
+
+def synthetic_LFP(duration=60., dt=1e-4, n_channels=1,
+                  epoch_duration=2.,
+                  slow_freq=3., gamma_band=[60., 160.],
+                  noise_level=0.2,
+                  seed=0):
+    """
+    synthetic recording alternating between:
+    - rhythmic epochs: 2-4Hz oscillation (slow_freq, with jitter) with gamma bursts on its up-phases
+    - asynchronous epochs: continuous high-gamma activity without slow oscillation
+    of random durations around "epoch_duration", on top of 1/f noise
+
+    returns a "data" dictionary (as IO.load_formatted_data) and the mask of the asynchronous samples
+    """
+    rng = np.random.default_rng(seed)
+    N = int(duration/dt)
+
+    # epochs
+    asynchronous, i0, state = np.zeros(N, dtype=bool), 0, False
+    while i0<N:
+        i1 = i0+int(rng.exponential(epoch_duration)/dt)+1
+        asynchronous[i0:i1] = state
+        i0, state = i1, not state
+
+    # high-gamma band-limited noise (shared generator, filtered in the Fourier domain)
+    freqs = np.fft.rfftfreq(N, dt)
+    band = (freqs>gamma_band[0]) & (freqs<gamma_band[1])
+
+    data = {'dt':dt, 'gain':1., 'Channel_Keys':[]}
+    for c in range(n_channels):
+        phase = 2*np.pi*np.cumsum(slow_freq*(1.+0.2*rng.standard_normal(N)*np.sqrt(dt)))*dt
+        slow = np.sin(phase)
+        gamma = np.fft.irfft(np.fft.rfft(rng.standard_normal(N))*band, N)
+        gamma /= np.std(gamma)
+        pink = np.fft.irfft(np.fft.rfft(rng.standard_normal(N))/np.sqrt(np.maximum(freqs, 1.)), N)
+        pink *= noise_level/np.std(pink)
+        Vext = np.where(asynchronous,
+                        0.5*gamma, # desynchronized: gamma activity, no slow rhythm
+                        slow+0.3*gamma*(slow>0)) # rhythmic: slow waves with gamma on up-states
+        key = 'Channel-%i' % (c+1)
+        data[key] = (Vext+pink).astype(np.float32)
+        data['Channel_Keys'].append(key)
+    return data, asynchronous
+
+def peak_rss_MB():
+    """peak resident memory of the current process (in MB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1e6 if sys.platform=='darwin' else rss/1e3 # bytes on macOS, kB on Linux
+
+def run_case(benchmark, duration, acq_freq, n_channels=1, workers=1, folder=''):
+    """
+    runs a single benchmark case (in the current process), returns its timing and memory
+    (throughputs are given in raw samples per second, summed over channels for the multichannel and IO cases,
+    the shared multichannel case runs one process per channel)
+    """
+    data, _ = synthetic_LFP(duration=duration, dt=1./acq_freq, n_channels=n_channels)
+    key, N = data['Channel_Keys'][0], len(data['Channel-1'])
+    freqs = np.linspace(50, 300, 5)
+
+    # inputs of the NSI stages (not timed)
+    if benchmark in ['compute_Network_State_Index', 'Validate_Network_States']:
+        functions.preprocess_LFP(data, freqs=freqs, Vext_key=key, workers=workers)
+        if benchmark=='Validate_Network_States':
+            functions.compute_Network_State_Index(data, workers=workers)
+    elif benchmark in ['load_npz', 'load_h5']:
+        filename = os.path.join(folder, 'benchmark'+('.npz' if benchmark=='load_npz' else '.h5'))
+        to_save = {k:data[k] for k in data['Channel_Keys']}
+        to_save['dt'] = np.array(data['dt'])
+        if benchmark=='load_npz':
+            np.savez(filename, **to_save)
+        else:
+            save_dict_to_hdf5(to_save, filename)
+    rss0 = peak_rss_MB()
+
+    tstart = time.perf_counter()
+    if benchmark=='my_cwt':
+        functions.my_cwt(data[key], freqs, data['dt'], workers=workers)
+    elif benchmark=='my_cwt_envelope':
+        functions.my_cwt_envelope(data[key], freqs, data['dt'], workers=workers)
+    elif benchmark=='preprocess_LFP':
+        functions.preprocess_LFP(data, freqs=freqs, Vext_key=key, workers=workers)
+    elif benchmark=='preprocess_LFP_chunked':
+        functions.preprocess_LFP(data, freqs=freqs, Vext_key=key, workers=workers, chunk_duration=10.)
+    elif benchmark=='compute_Network_State_Index':
+        functions.compute_Network_State_Index(data, workers=workers)
+    elif benchmark=='Validate_Network_States':
+        functions.Validate_Network_States(data, Tstate=200e-3, Var_criteria=data['p0'])
+    elif benchmark=='multichannel_Network_State_Index':
+        functions.multichannel_Network_State_Index(np.array([data[k] for k in data['Channel_Keys']]),
+                                                   data['dt'], Channel_Keys=data['Channel_Keys'],
+                                                   freqs=freqs, workers=workers)
+    elif benchmark=='shared_multichannel_Network_State_Index':
+        shared_multichannel_Network_State_Index([data[k] for k in data['Channel_Keys']], data['dt'],
+                                                Channel_Keys=data['Channel_Keys'], freqs=freqs,
+                                                processes=n_channels, workers=workers)
+    elif benchmark in ['load_npz', 'load_h5']:
+        loaded = load_formatted_data(filename)
+        np.sum([np.sum(loaded[k]) for k in loaded['Channel_Keys']]) # forcing the read
+    else:
+        raise ValueError('Unknown benchmark: %s' % benchmark)
+    wall_time = time.perf_counter()-tstart
+
+    n_samples = N*(n_channels if benchmark in MULTICHANNEL else 1)
+    return {'benchmark':benchmark, 'duration':duration, 'acq_freq':acq_freq,
+            'n_channels':n_channels, 'workers':workers,
+            'n_samples':n_samples, 'wall_time':wall_time,
+            'throughput':n_samples/wall_time,
+            'peak_rss_MB':peak_rss_MB(), 'case_rss_MB':peak_rss_MB()-rss0}
+
+def run_benchmarks(benchmarks=BENCHMARKS,
+                   durations=[10., 60.],
+                   acq_freqs=[1e4],
+                   channels=[1, 4],
+                   workers=[1],
+                   repeat=1):
+    """
+    runs all combinations of the parameters (channel counts only for the multichannel and IO cases),
+    each case in a fresh process, the best of "repeat" runs is kept
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for benchmark in benchmarks:
+            for duration in durations:
+                for acq_freq in acq_freqs:
+                    for n_channels in (channels if benchmark in MULTICHANNEL else [1]):
+                        for w in workers:
+                            runs = []
+                            for r in range(repeat):
+                                with ProcessPoolExecutor(max_workers=1) as executor:
+                                    runs.append(executor.submit(run_case, benchmark, duration, acq_freq,
+                                                                n_channels, w, folder).result())
+                            result = min(runs, key=lambda run: run['wall_time'])
+                            print(' - %s [%.0fs, %.0fkHz, %i channel(s), %i worker(s)]: %.3fs, %.2e samples/s, peak RSS: %.0fMB' %\
+                                  (benchmark, duration, 1e-3*acq_freq, n_channels, w,
+                                   result['wall_time'], result['throughput'], result['peak_rss_MB']))
+                            results.append(result)
+    return results
+
+def environment():
+    """versions and machine, stored with the results"""
+    try:
+        import subprocess
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=pathlib.Path(__file__).resolve().parents[1],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = ''
+    return {'date':datetime.datetime.now().isoformat(), 'commit':commit,
+            'python':platform.python_version(), 'numpy':np.__version__, 'scipy':scipy.__version__,
+            'machine':platform.machine(), 'processor':platform.processor(), 'cpu_count':os.cpu_count()}
+
+def case_key(result):
+    return (result['benchmark'], result['duration'], result['acq_freq'], result['n_channels'], result['workers'])
+
+def compare(results, reference, tolerance=0.2):
+    """
+    cases whose throughput dropped by more than "tolerance" (relative) with respect to a previous run
+    """
+    previous = {case_key(r):r for r in reference['results']}
+    regressions = []
+    for result in results:
+        if case_key(result) in previous:
+            ratio = result['throughput']/previous[case_key(result)]['throughput']
+            if ratio<(1.-tolerance):
+                regressions.append(dict(result, slowdown=1./ratio))
+    return regressions
+
+def main(argv=None):
+
+    import argparse
+    parser=argparse.ArgumentParser(description="Benchmarks of the Network State Index analysis",
+                                   formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-b', "--benchmarks", nargs='*', type=str, default=BENCHMARKS,
+                        help='among: %s' % ', '.join(BENCHMARKS))
+    parser.add_argument("--durations", nargs='*', type=float, default=[10., 60.], help='in s')
+    parser.add_argument("--acq_freqs", nargs='*', type=float, default=[10.], help='in kHz')
+    parser.add_argument("--channels", nargs='*', type=int, default=[1, 4])
+    parser.add_argument('-w', "--workers", nargs='*', type=int, default=[1],
+                        help='thread counts, e.g. "1 8 32" to measure the parallel speedup')
+    parser.add_argument('-r', "--repeat", type=int, default=1)
+    parser.add_argument('-o', "--output", type=str, default='',
+                        help='json file where to store the results')
+    parser.add_argument("--compare", type=str, default='',
+                        help='json file of a previous run, the throughput regressions are reported')
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help='relative throughput drop considered as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.benchmarks, durations=args.durations,
+                             acq_freqs=[1e3*f for f in args.acq_freqs],
+                             channels=args.channels, workers=args.workers, repeat=args.repeat)
+    if args.output!='':
+        with open(args.output, 'w') as f:
+            json.dump({'environment':environment(), 'results':results}, f, indent=2)
+    if args.compare!='':
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), tolerance=args.tolerance)
+        for r in regressions:
+            print(' /!\\ regression: %s [%.0fs, %.0fkHz, %i channel(s), %i worker(s)] is %.2fx slower' %\
+                  (r['benchmark'], r['duration'], 1e-3*r['acq_freq'], r['n_channels'], r['workers'], r['slowdown']))
+        print('%i regression(s) with respect to %s' % (len(regressions), args.compare))
+        return len(regressions)
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Persistent cache of the pLFP (output of "preprocess_LFP") and of the plotting pyramids (see pyramid.py),
+
+entries are keyed by a hash of the channel content and of the pLFP parameters,
+and stored as HDF5 files (see IO.save_dict_to_hdf5) in a folder with a size cap (LRU eviction)
+"""
+import sys, os, pathlib, hashlib, inspect, json
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+
+from NSI import functions
+from NSI.pyramid import MinMax_Pyramid
+from NSI.quantiles import KLL_Sketch
+from NSI.IO import save_dict_to_hdf5, load_dict_from_hdf5
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'NSI', 'pLFP')
+
+# parameters of preprocess_LFP that do not change its pLFP output
+NOT_IN_KEY = ['data', 'Vext_key', 'pLFP_unit', 'chunk_duration', 'keep_coefficients', 'progress', 'on_chunk', 'workers']
+
+def hash_array(array, chunk_size=int(1e7)):
+    """
+    content hash of a 1-D array, read chunk by chunk (works for memmaps and h5py datasets)
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(np.dtype(array.dtype)).encode())
+    for i0 in range(0, len(array), chunk_size):
+        h.update(np.ascontiguousarray(array[i0:i0+chunk_size]).tobytes())
+    return h.hexdigest()
+
+
+class pLFP_Cache:
+    """
+    on-disk cache of the pLFP, use:
+
+    cache = pLFP_Cache()
+    cache.preprocess_LFP(data, Vext_key='Extra', freqs=...) # same arguments than functions.preprocess_LFP
+    cache.clear() # to invalidate all entries
+    """
+
+    def __init__(self, folder=DEFAULT_FOLDER, max_size=2e9):
+        """max_size: maximum size (in bytes) of the cache folder"""
+        self.folder, self.max_size = folder, max_size
+        os.makedirs(self.folder, exist_ok=True)
+        self.hits, self.misses = 0, 0
+
+    def key(self, Vext, dt, **args):
+        """
+        hash of the channel content and of the pLFP parameters (preprocess_LFP defaults if not given)
+        """
+        params = {k:v.default for k, v in inspect.signature(functions.preprocess_LFP).parameters.items()\
+                  if k not in NOT_IN_KEY}
+        params.update({k:v for k, v in args.items() if k not in NOT_IN_KEY})
+        params['freqs'] = [float(f) for f in params['freqs']]
+        params['dtype'] = np.dtype(params['dtype']).str
+        params['dt'] = float(dt)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(hash_array(Vext).encode())
+        h.update(json.dumps(params, sort_keys=True, # (numpy scalars and arrays, e.g. the gain of a file, as lists/numbers)
+                            default=lambda v: np.asarray(v).tolist()).encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.folder, key+'.h5')
+
+    def get(self, key):
+        """cached pLFP dictionary or None"""
+        if os.path.isfile(self.filename(key)):
+            os.utime(self.filename(key)) # marked as recently used
+            self.hits += 1
+            return load_dict_from_hdf5(self.filename(key))
+        else:
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        # written in a temporary file first, so that interrupted writes do not leave corrupted entries
+        save_dict_to_hdf5(entry, self.filename(key)+'.tmp')
+        os.replace(self.filename(key)+'.tmp', self.filename(key))
+        self.evict()
+
+    def entries(self):
+        """cached files, from the least to the most recently used"""
+        filenames = [os.path.join(self.folder, f) for f in os.listdir(self.folder) if f.endswith('.h5')]
+        return sorted(filenames, key=os.path.getmtime)
+
+    def size(self):
+        return np.sum([os.path.getsize(f) for f in self.entries()])
+
+    def evict(self):
+        """removes the least recently used entries until the cache fits in max_size"""
+        entries, size = self.entries(), self.size()
+        while (size>self.max_size) and (len(entries)>0):
+            size -= os.path.getsize(entries[0])
+            os.remove(entries.pop(0))
+
+    def clear(self):
+        """invalidates the whole cache"""
+        for f in self.entries():
+            os.remove(f)
+
+    def preprocess_LFP(self, data, Vext_key='Extra', **args):
+        """
+        functions.preprocess_LFP with a cache lookup of the pLFP,
+        on a hit: "pLFP", "p0", "new_t", "new_dt" and "pLFP_freqs" (and "p0_sketch") are loaded from the cache
+        """
+        if args.get('keep_coefficients', False): # the wavelet coefficients are not cached
+            return functions.preprocess_LFP(data, Vext_key=Vext_key, **args)
+
+        key = self.key(data[Vext_key], data['dt'], **args)
+        entry = self.get(key)
+        if entry is None:
+            functions.preprocess_LFP(data, Vext_key=Vext_key, **args)
+            entry = {k:np.array(data[k]) for k in ['pLFP', 'p0', 'new_t', 'new_dt', 'pLFP_freqs']}
+            if 'p0_sketch' in data:
+                entry['p0_sketch'] = data['p0_sketch'].to_dict()
+            self.put(key, entry)
+        else:
+            data.pop('W', None) # removing coefficients of a previous analysis
+            data['pLFP'], data['new_t'], data['pLFP_freqs'] = entry['pLFP'], entry['new_t'], entry['pLFP_freqs']
+            data['p0'], data['new_dt'] = entry['p0'][()], float(entry['new_dt'])
+            data.pop('p0_sketch', None)
+            if 'p0_sketch' in entry:
+                data['p0_sketch'] = KLL_Sketch.from_dict(entry['p0_sketch'])
+
+    def pyramid(self, signal, dt):
+        """
+        min/max pyramid of a signal (see pyramid.MinMax_Pyramid), built only if not cached
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(('pyramid-%s-' % float(dt)).encode())
+        h.update(hash_array(signal).encode())
+        key = h.hexdigest()
+        entry = self.get(key)
+        if entry is None:
+            pyramid = MinMax_Pyramid(signal, dt)
+            self.put(key, pyramid.to_dict())
+            return pyramid
+        return MinMax_Pyramid.from_dict(signal, entry)
+
+
+if __name__=='__main__':
+
+    import argparse
+    parser=argparse.ArgumentParser(description="Management of the pLFP cache",
+                                   formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--folder", type=str, default=DEFAULT_FOLDER)
+    parser.add_argument("--clear", action="store_true", help='invalidate all cached entries')
+    args = parser.parse_args()
+
+    cache = pLFP_Cache(args.folder)
+    if args.clear:
+        cache.clear()
+    print('pLFP cache: %s, %i entries, %.1f MB' % (cache.folder, len(cache.entries()), 1e-6*cache.size()))
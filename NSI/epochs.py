@@ -0,0 +1,150 @@
+"""
+Network-state epochs: run-length encoding of the validated NSI into a columnar table
+
+each tested state (see functions.Validate_Network_States) stands for the interval of "step" samples
+centered on it, consecutive tested states of the same class are merged into an epoch:
+
+table = network_state_epochs(data)
+long_asynchronous = table.select('asynchronous', min_duration=1.)
+states = table.join(stimulus_times)['state'] # state at each stimulus (-1: not in an epoch)
+"""
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+
+STATES = ['unvalidated', 'rhythmic', 'asynchronous'] # state codes: 0, 1, 2
+COLUMNS = ['start', 'stop', 'state', 'mean_NSI', 'i_start', 'i_stop']
+
+
+def state_code(state):
+    return STATES.index(state) if isinstance(state, str) else int(state)
+
+
+class Epoch_Table:
+    """
+    columns (1-D arrays, one entry per epoch, sorted by time, non-overlapping):
+    - 'start', 'stop': epoch bounds (in s)
+    - 'state': state code (index in STATES)
+    - 'mean_NSI': mean NSI over the epoch samples
+    - 'i_start', 'i_stop': epoch bounds (in samples of the pLFP)
+
+    the starts are the sorted interval index: a time point is located with a single searchsorted
+    """
+
+    def __init__(self, columns):
+        self.columns = {key:np.asarray(columns[key]) for key in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def duration(self):
+        return self['stop']-self['start']
+
+    def subset(self, mask):
+        return Epoch_Table({key:values[mask] for key, values in self.columns.items()})
+
+    def select(self, state=None, min_duration=0., max_duration=np.inf):
+        """epochs of a given state (name or code) and duration range (in s)"""
+        duration = self.duration()
+        mask = (duration>=min_duration) & (duration<=max_duration)
+        if state is not None:
+            mask &= (self['state']==state_code(state))
+        return self.subset(mask)
+
+    def lookup(self, times):
+        """index of the epoch containing each time (-1 if not within an epoch), O(log n) per time"""
+        times = np.asarray(times, dtype=float)
+        index = np.searchsorted(self['start'], times, side='right')-1
+        inside = (index>=0) & (times<self['stop'][np.maximum(index, 0)]) if len(self)>0 else np.zeros(times.shape, dtype=bool)
+        return np.where(inside, index, -1)
+
+    def join(self, times):
+        """
+        epoch columns at each time (e.g. stimulus timestamps), as a dictionary of arrays:
+        'time', 'epoch' (index, -1 if outside of all epochs), the table columns
+        (state=-1, NaN or -1 outside of epochs) and 'time_in_epoch' (since its start, in s)
+        """
+        times = np.asarray(times, dtype=float)
+        index = self.lookup(times)
+        inside, safe = (index>=0), np.maximum(index, 0)
+        joined = {'time':times, 'epoch':index}
+        for key, values in self.columns.items():
+            if len(self)==0:
+                joined[key] = np.full(times.shape, (np.nan if values.dtype.kind=='f' else -1))
+            elif values.dtype.kind=='f':
+                joined[key] = np.where(inside, values[safe], np.nan)
+            else:
+                joined[key] = np.where(inside, values[safe], -1)
+        joined['time_in_epoch'] = np.where(inside, times-joined['start'], np.nan)
+        return joined
+
+    def state_at(self, times):
+        """state code at each time (-1 if not within an epoch)"""
+        return self.join(times)['state']
+
+    def to_dict(self):
+        """columns as a dictionary of arrays (see IO.save_dict_to_hdf5)"""
+        return dict(self.columns)
+
+    @classmethod
+    def from_dict(cls, columns):
+        return cls(columns)
+
+
+def network_state_epochs(data):
+    """
+    epoch table (see Epoch_Table) of an analyzed "data" (see functions.compute_Network_State_Index),
+    in O(N): the tested states are the validated and unvalidated samples,
+    their class is "unvalidated", or "rhythmic" (NSI<=0) and "asynchronous" (NSI>0) if validated
+    """
+    N = len(data['NSI'])
+    tested = np.flatnonzero(np.asarray(data['NSI_validated']) | np.asarray(data['NSI_unvalidated']))
+    if len(tested)==0:
+        return Epoch_Table({key:np.zeros(0, dtype=(np.int64 if key in ['state', 'i_start', 'i_stop'] else float))
+                            for key in COLUMNS})
+    NSI = np.asarray(data['NSI'], dtype=np.float64)
+    state = np.where(np.asarray(data['NSI_validated'])[tested],
+                     np.where(NSI[tested]>0, 2, 1), 0).astype(np.int64)
+
+    # samples represented by each tested state (tested every "step" samples)
+    step = int(np.min(np.diff(tested))) if len(tested)>1 else 1
+    first = np.concatenate([[0], np.flatnonzero(np.diff(state)!=0)+1]) # runs of the same state
+    last = np.concatenate([first[1:], [len(tested)]])-1
+    i_start = np.clip(tested[first]-int(step/2), 0, N)
+    i_stop = np.clip(tested[last]-int(step/2)+step, 0, N)
+
+    cumulative = np.concatenate([[0.], np.cumsum(NSI)])
+    t0 = float(data['new_t'][0]) if len(data['new_t'])>0 else 0.
+    return Epoch_Table({'start':t0+i_start*data['new_dt'],
+                        'stop':t0+i_stop*data['new_dt'],
+                        'state':state[first],
+                        'mean_NSI':(cumulative[i_stop]-cumulative[i_start])/np.maximum(i_stop-i_start, 1),
+                        'i_start':i_start.astype(np.int64),
+                        'i_stop':i_stop.astype(np.int64)})
+
+
+if __name__=='__main__':
+
+    # regression check: the table agrees with a sample-by-sample scan of the validated NSI
+    from NSI.functions import preprocess_LFP, compute_Network_State_Index
+    from NSI.benchmark import synthetic_LFP
+    data, _ = synthetic_LFP(duration=120.)
+    preprocess_LFP(data, Vext_key='Channel-1')
+    compute_Network_State_Index(data)
+    table = network_state_epochs(data)
+
+    times = np.random.uniform(0, 120., 10000)
+    i = (times/data['new_dt']).astype(int)
+    tested = np.flatnonzero(data['NSI_validated'] | data['NSI_unvalidated'])
+    step = tested[1]-tested[0]
+    nearest = tested[np.maximum(np.searchsorted(tested-int(step/2), i, side='right')-1, 0)] # state covering i
+    expected = np.where(data['NSI_validated'][nearest], np.where(data['NSI'][nearest]>0, 2, 1), 0)
+    found = table.state_at(times)
+    covered = found>=0
+    assert np.all(found[covered]==expected[covered])
+    assert np.allclose(table['mean_NSI'], [np.mean(data['NSI'][i0:i1]) for i0, i1 in zip(table['i_start'], table['i_stop'])])
+    print('%i epochs, %i asynchronous epochs longer than 1s, %.1f%% of the times within an epoch' %\
+          (len(table), len(table.select('asynchronous', min_duration=1.)), 100*np.mean(covered)))
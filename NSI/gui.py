@@ -5,6 +5,9 @@ sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
 from NSI.functions import * # all functions required to make the analysis
 from NSI.IO import * # module to load data, including electrophysiogical recordings
+from NSI.cache import pLFP_Cache # on-disk cache of the pLFP
+from NSI.pyramid import MinMax_Pyramid # multi-resolution min/max envelopes for plotting
+from NSI.pipeline import NSI_Pipeline # staged analysis, recomputing only what changed
 
 # then modules for GUI
 import matplotlib
@@ -24,18 +27,40 @@ matplotlib.rcParams.update({'axes.labelsize': FONTSIZE,
                             'xtick.labelsize': FONTSIZE,
                             'ytick.labelsize': FONTSIZE})
 
-
-DEFAULT_VALUES = {'alpha':2.95,
-                  'Tstate':200,
-                  'acq_freq_kHz':10., # in kHz
-                  'gain_mVpV':1., # mV / V
-                  'Tsmooth':42.,
-                  'Tsubsampling':5.,
-                  'p0_percentile':1.,
-                  'Root_freq':72.,
-                  'Band_Factor':1.8,
-                  'N_wavelets':10,
-                  'xlim':[0,20]}
+class Analysis_Worker(QtCore.QObject):
+    """
+    runs the analysis pipeline outside of the GUI thread (see Window.analyze),
+    it reports its progress through Qt signals and can be cancelled between two wavelets
+    """
+    progress = QtCore.pyqtSignal(float, str)
+    chunk = QtCore.pyqtSignal(object) # mean wavelet envelope of the chunks computed so far
+    finished = QtCore.pyqtSignal(list) # recomputed stages
+    cancelled = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, pipeline, Vext_key, params):
+        super(Analysis_Worker, self).__init__()
+        self.pipeline, self.Vext_key, self.params = pipeline, Vext_key, params
+        self.cancel_requested = False
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def report(self, fraction, message):
+        if self.cancel_requested:
+            raise Analysis_Cancelled()
+        self.progress.emit(fraction, message)
+
+    def run(self):
+        try:
+            computed = self.pipeline.run_with_params(self.Vext_key, self.params,
+                                                     progress=self.report,
+                                                     on_chunk=lambda output, n: self.chunk.emit(np.array(output[:n])))
+            self.finished.emit(computed)
+        except Analysis_Cancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(repr(e))
 
 
 class Window(QtWidgets.QMainWindow):
@@ -45,9 +70,9 @@ class Window(QtWidgets.QMainWindow):
         super(Window, self).__init__(parent)
         
         # buttons and functions
-        LABELS = ["q) Quit", "o) Open File", "r) Run analysis", "s) Save Results",
+        LABELS = ["q) Quit", "o) Open File", "r) Run analysis", "c) Cancel analysis", "s) Save Results",
                   "Zoom1", "Zoom2", "Reset Settings"]
-        FUNCTIONS = [self.close_app, self.file_open, self.analyze, self.save_results,\
+        FUNCTIONS = [self.close_app, self.file_open, self.analyze, self.cancel_analysis, self.save_results,\
                      self.zoom1, self.zoom2, self.reset_program_settings]
         button_length = 130
         self.setWindowTitle('Computing the Network State Index')
@@ -64,6 +89,7 @@ class Window(QtWidgets.QMainWindow):
         rect = screen.availableGeometry()
         self.screensize = rect.width(), rect.height()
 
+        self.buttons = {} # label --> (button, menu action)
         for func, label, shift in zip(FUNCTIONS, LABELS,\
                                       button_length*np.arange(len(LABELS))):
             btn = QtWidgets.QPushButton(label, self)
@@ -74,6 +100,7 @@ class Window(QtWidgets.QMainWindow):
             action.setShortcut(label.split(')')[0])
             action.triggered.connect(func)
             self.fileMenu.addAction(action)
+            self.buttons[label] = (btn, action)
 
         self.window,\
             self.AX_large_view, self.AX_zoom,\
@@ -91,6 +118,10 @@ class Window(QtWidgets.QMainWindow):
             pass
 
         self.folder = './data/'
+        self.cache = pLFP_Cache() # the pLFP is recomputed only if the data or its parameters changed
+        self.pipeline = NSI_Pipeline(self.data, cache=self.cache, workers=os.cpu_count())
+        self.pyramids = {} # min/max pyramids of the plotted signals (see NSI/pyramid.py)
+        self.thread, self.worker = None, None # analysis running in the background
         self.filename = (datafile if datafile is not None else '')
         
         ## ------------ Recording and Analysis parameters ----------- ##
@@ -106,7 +137,25 @@ class Window(QtWidgets.QMainWindow):
         self.window.show()    
         self.show()
 
+    def busy(self):
+        """True (with a message) if an analysis is running: the data can not be read or replaced"""
+        if self.thread is not None:
+            self.statusBar.showMessage("Analysis running, wait for it or cancel it first (c)")
+            return True
+        return False
+
+    def set_analysis_running(self, running):
+        """disables the actions reading or replacing the data while the analysis runs"""
+        for label, (btn, action) in self.buttons.items():
+            if label not in ["q) Quit", "r) Run analysis", "c) Cancel analysis"]:
+                btn.setEnabled(not running)
+                action.setEnabled(not running)
+        for widget in [self.set_acq_channel, self.set_acq_freq, self.set_acq_gain]:
+            widget.setEnabled(not running)
+
     def zoom1(self):
+        if self.busy():
+            return
         if 'pLFP' in self.data:
             self.large_scale_plot_NSI()
         else:
@@ -118,12 +167,16 @@ class Window(QtWidgets.QMainWindow):
                              rectprops = dict(facecolor='red', edgecolor = 'black', alpha=0.5, fill=True))
         
     def zoom2(self):
+        if self.busy():
+            return
         self.statusBar.showMessage('Draw a rectangle in the "BOTTOM-Vext" plot to set a new zoom')
         self.rs=RectangleSelector(self.AX_zoom[0], self.onselect,
                              drawtype='box',
                              rectprops = dict(facecolor='red', edgecolor = 'black', alpha=0.5, fill=True))
         
     def onselect(self, eclick, erelease):
+        if self.busy(): # (selector drawn before the analysis started)
+            return
         self.params['xlim'] = [min([eclick.xdata, erelease.xdata]), max([eclick.xdata, erelease.xdata])]
         self.zoom_plot()
         
@@ -133,7 +186,10 @@ class Window(QtWidgets.QMainWindow):
 
         self.statusBar.showMessage('loading data [...]')
         
-        self.data = load_formatted_data(self.filename) # see function in NSI/IO.py
+        self.data = load_formatted_data(self.filename, lazy=True) # see function in NSI/IO.py
+        # channels are read from disk by chunks during the analysis
+        self.pipeline = NSI_Pipeline(self.data, cache=self.cache, chunk_duration=60., workers=os.cpu_count())
+        self.pyramids = {}
         print(self.data)
         self.Vext_key = self.data['Channel_Keys'][0] # first key by default
         
@@ -157,9 +213,24 @@ class Window(QtWidgets.QMainWindow):
         self.set_acq_gain.setValue(1e-3*self.data['gain'])
         
         self.nsamples = len(self.data[self.Vext_key])
+        self.pyramid(self.Vext_key, self.data['dt']) # built once per channel
         self.filename_textbox.setText('Filename: '+self.filename)
         # self.statusBar.showMessage('Data loaded, now "Run Analysis"')
         
+    def pyramid(self, key, dt):
+        """
+        min/max pyramid of data[key] for plotting, built once:
+        the pyramids of the raw channels are stored in the cache, the ones of the analysis outputs
+        (cheap to build, recomputed at each parameter change) are kept in memory only
+        """
+        dt = float(dt) # (0-d arrays for the npz files)
+        if (key, dt) not in self.pyramids:
+            if key in self.data.get('Channel_Keys', [self.Vext_key]):
+                self.pyramids[(key, dt)] = self.cache.pyramid(self.data[key], dt)
+            else:
+                self.pyramids[(key, dt)] = MinMax_Pyramid(self.data[key], dt)
+        return self.pyramids[(key, dt)]
+
     def large_scale_plot(self, Nplot=2000):
         """
         We plot everything on a single axis,
@@ -172,11 +243,11 @@ class Window(QtWidgets.QMainWindow):
             
         # large scale version
         if (self.Vext_key in self.data) and ('dt' in self.data):
-            lfp_to_plot = self.data[self.Vext_key][::int(self.nsamples/Nplot)]
+            t, lfp_to_plot = self.pyramid(self.Vext_key, self.data['dt']).window(0, self.data['dt']*self.nsamples,
+                                                                                  Nplot=Nplot)
             ymin, ymax, ymean = np.min(lfp_to_plot), np.max(lfp_to_plot), np.mean(lfp_to_plot)
             scaling = 10./(ymax-ymin)
-            self.AX_large_view.plot(np.arange(len(lfp_to_plot))*self.data['dt']*int(self.nsamples/Nplot),
-                                    (lfp_to_plot-ymean)*scaling+15., lw=0.5, color=Grey)
+            self.AX_large_view.plot(t, (lfp_to_plot-ymean)*scaling+15., lw=0.5, color=Grey)
             self.AX_large_view.set_xlim([0, self.data['dt']*self.nsamples])
             self.canvas_large_view.draw()
         # else:
@@ -187,12 +258,12 @@ class Window(QtWidgets.QMainWindow):
         # large scale version
         if 'pLFP' in self.data:
             Nsamples = len(self.data['pLFP'])
-            plfp_to_plot = self.data['pLFP'][::int(Nsamples/Nplot)]
+            t, plfp_to_plot = self.pyramid('pLFP', self.data['new_dt']).window(0, self.data['new_dt']*Nsamples,
+                                                                                Nplot=Nplot)
 
             ymin, ymax, ymean = np.min(plfp_to_plot), np.max(plfp_to_plot), np.mean(plfp_to_plot)
             scaling = 10./(ymax-ymin)
-            self.AX_large_view.plot(np.arange(len(plfp_to_plot))*self.data['new_dt']*int(Nsamples/Nplot),
-                                    (plfp_to_plot-ymean)*scaling+5., lw=0.5, color=Brown)
+            self.AX_large_view.plot(t, (plfp_to_plot-ymean)*scaling+5., lw=0.5, color=Brown)
 
             y = self.data['NSI'][self.data['NSI_validated']]
             ymin, ymax, ymean = np.min(y), np.max(y), np.mean(y)
@@ -217,29 +288,23 @@ class Window(QtWidgets.QMainWindow):
                 del ax.collections[-1] # removing the previous plots
 
         if ((self.Vext_key in self.data) and ('dt' in self.data)):
-            i1, i2 = int(self.params['xlim'][0]/self.data['dt']), int(self.params['xlim'][1]/self.data['dt'])
-            isubsampling = max([1,int((i2-i1)/Nplot)])
-            lfp_to_plot = self.data['gain']*self.data[self.Vext_key][i1:i2][::isubsampling]
-            self.AX_zoom[0].plot(np.arange(len(lfp_to_plot))*self.data['dt']*isubsampling+self.params['xlim'][0],
-                                 lfp_to_plot, lw=0.5, color=Grey)
+            t, lfp_to_plot = self.pyramid(self.Vext_key, self.data['dt']).window(*self.params['xlim'], Nplot=Nplot)
+            lfp_to_plot = self.data['gain']*lfp_to_plot
+            self.AX_zoom[0].plot(t, lfp_to_plot, lw=0.5, color=Grey)
             y1, y2 = np.min(lfp_to_plot), np.max(lfp_to_plot)
             self.AX_zoom[0].set_ylim([y1-0.05*(y2-y1), y2+0.05*(y2-y1)])
 
         if ('pLFP' in self.data):
             
-            i1, i2 = int(self.params['xlim'][0]/self.data['new_dt']), int(self.params['xlim'][1]/self.data['new_dt'])
             # plotting pLFP variations
-            isubsampling = max([1,int((i2-i1)/Nplot)])
-            plfp_to_plot = self.data['pLFP'][i1:i2][::isubsampling]
-            self.AX_zoom[1].plot(np.arange(len(plfp_to_plot))*self.data['new_dt']*isubsampling+self.params['xlim'][0],
-                                 plfp_to_plot, lw=1, color=Brown)
+            t, plfp_to_plot = self.pyramid('pLFP', self.data['new_dt']).window(*self.params['xlim'], Nplot=Nplot)
+            self.AX_zoom[1].plot(t, plfp_to_plot, lw=1, color=Brown)
             y1, y2 = np.min(plfp_to_plot), np.max(plfp_to_plot)
             self.AX_zoom[1].set_ylim([y1-0.05*(y2-y1), y2+0.05*(y2-y1)])
             
             # plotting NSI variations
-            nsi_to_plot = self.data['NSI'][i1:i2][::isubsampling]
-            self.AX_zoom[2].plot(np.arange(len(plfp_to_plot))*self.data['new_dt']*isubsampling+self.params['xlim'][0],
-                                 nsi_to_plot, lw=0.5, color='k')
+            t, nsi_to_plot = self.pyramid('NSI', self.data['new_dt']).window(*self.params['xlim'], Nplot=Nplot)
+            self.AX_zoom[2].plot(t, nsi_to_plot, lw=0.5, color='k')
             self.AX_zoom[2].plot(self.params['xlim'], [0,0], '--', lw=0.1, color='k')
             # self.AX_zoom[2].set_ylim([np.min(plfp_to_plot), np.max(plfp_to_plot)])
 
@@ -271,26 +336,84 @@ class Window(QtWidgets.QMainWindow):
         # else:
         #     self.statusBar.showMessage('No data available [...]')
         
+    def analysis_params(self):
+        """analysis parameters currently set in the GUI (see DEFAULT_VALUES)"""
+        return {'Root_freq':self.set_rootfreq.value(),
+                'Band_Factor':self.set_bandfactor.value(),
+                'N_wavelets':int(self.set_N_wvlts.value()),
+                'Tsubsampling':self.set_subsampling.value(),
+                'Tsmooth':self.set_Tsmooth.value(),
+                'Tstate':self.set_Tstate.value(),
+                'alpha':self.set_alpha.value()}
+        
     def analyze(self):
+        """
+        runs the analysis in a background thread (see Analysis_Worker), the GUI stays responsive
+        """
+        if self.thread is not None:
+            self.statusBar.showMessage("Analysis already running, cancel it first (c)")
+            return
         self.statusBar.showMessage("Analyzing data [...]")
-        f0, w0 = self.set_rootfreq.value(), self.set_bandfactor.value()
-        preprocess_LFP(self.data,
-                       gain = self.data['gain'],
-                       Vext_key=self.Vext_key,
-                       freqs = np.linspace(f0/w0, f0*w0, int(self.set_N_wvlts.value())),
-                       # percentile_for_p0=self.set_p0_percentile.value()/100.,                   
-                       new_dt = self.set_subsampling.value()*1e-3,
-                       smoothing=self.set_Tsmooth.value()*1e-3)
-        compute_Network_State_Index(self.data,
-                                    Tstate=self.set_Tstate.value()*1e-3,
-                                    T_sliding_mean=2.*self.set_Tstate.value()*1e-3,
-                                    alpha=self.set_alpha.value())
+        self.thread = QtCore.QThread()
+        self.worker = Analysis_Worker(self.pipeline, self.Vext_key, self.analysis_params())
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.analysis_progress)
+        self.worker.chunk.connect(self.analysis_chunk)
+        self.worker.finished.connect(self.analysis_finished)
+        self.worker.cancelled.connect(self.analysis_cancelled)
+        self.worker.failed.connect(self.analysis_failed)
+        self.set_analysis_running(True)
+        self.thread.start()
+
+    def cancel_analysis(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.statusBar.showMessage("Cancelling analysis [...]")
+
+    def analysis_progress(self, fraction, message):
+        self.statusBar.showMessage("Analyzing data [...] %s (%i%%)" % (message, 100*fraction))
+
+    def analysis_chunk(self, W2, Nplot=2000):
+        """incremental plot of the (unsmoothed) high-gamma envelope of the chunks computed so far"""
+        new_dt = self.analysis_params()['Tsubsampling']*1e-3
+        isubsampling = max([1, int(len(self.data[self.Vext_key])*self.data['dt']/new_dt/Nplot)])
+        W2 = W2[:int(len(W2)/isubsampling)*isubsampling].reshape(-1, isubsampling).max(axis=1)
+        if len(W2)>0:
+            self.large_scale_plot()
+            self.AX_large_view.plot(np.arange(len(W2))*new_dt*isubsampling,
+                                    (W2-W2.min())*10./(W2.max()-W2.min()+1e-12), lw=0.5, color=Brown)
+            self.canvas_large_view.draw()
+
+    def stop_analysis_thread(self):
+        self.thread.quit()
+        self.thread.wait()
+        self.thread, self.worker = None, None
+        self.set_analysis_running(False)
+
+    def analysis_finished(self, computed):
+        self.stop_analysis_thread()
+        for key in ['pLFP', 'NSI']: # pyramids of the recomputed signals
+            if key in computed:
+                self.pyramids.pop((key, float(self.data['new_dt'])), None)
+                self.pyramid(key, self.data['new_dt'])
         # now updating plots
+        self.large_scale_plot()
         self.large_scale_plot_NSI()
         self.zoom_plot()
-        self.statusBar.showMessage("Data Analyzed !")
+        self.statusBar.showMessage("Data Analyzed ! (recomputed: %s)" % (', '.join(computed) if len(computed)>0 else 'none'))
+
+    def analysis_cancelled(self):
+        self.stop_analysis_thread()
+        self.statusBar.showMessage("Analysis cancelled")
+
+    def analysis_failed(self, error):
+        self.stop_analysis_thread()
+        self.statusBar.showMessage("/!\\ Analysis failed: %s" % error)
     
     def file_open(self):
+        if self.busy():
+            return
         print(self.folder)
         name=QtWidgets.QFileDialog.getOpenFileName(self, 'Open File',\
                                                    self.folder)
@@ -315,7 +438,10 @@ class Window(QtWidgets.QMainWindow):
         self.set_acq_channel.update()
 
     def channel_change(self):
+        if self.busy():
+            return
         self.Vext_key = self.set_acq_channel.currentText()
+        self.pyramid(self.Vext_key, self.data['dt'])
         self.large_scale_plot()
         self.zoom_plot()
 
@@ -328,6 +454,9 @@ class Window(QtWidgets.QMainWindow):
         self.statusBar.showMessage('gain has changed, use the "zooms" updates to refresh the plots')
         
     def close_app(self):
+        if self.worker is not None: # interrupting the background analysis
+            self.worker.cancel()
+            self.stop_analysis_thread()
         if self.params is not None:
             self.params['filename'] = self.filename
             self.params['folder'] = self.folder
@@ -337,13 +466,12 @@ class Window(QtWidgets.QMainWindow):
         sys.exit()
         
     def save_results(self):
+        if self.busy():
+            return
         if 'NSI' in self.data:
-            results_filename = '.'.join(self.filename.split('.')[:-1]) if '.' in self.filename else self.filename
-            results_filename += '_NSI_'+datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')+'.h5'
+            results_filename = NSI_results_filename(self.filename)
             print(self.data.keys())
-            to_save = {'validated_times': self.data['new_t'][self.data['NSI_validated']],
-                       'validated_NSI':self.data['NSI'][self.data['NSI_validated']]}
-            save_dict_to_hdf5(to_save, results_filename)
+            save_NSI_results(self.data, results_filename, params=self.analysis_params())
             self.statusBar.showMessage('Results of analysis saved as : '+results_filename)
         else:
             self.statusBar.showMessage('Need to perform analysis first...')
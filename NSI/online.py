@@ -0,0 +1,297 @@
+"""
+Real-time (online) estimation of the Network State Index for closed-loop experiments
+
+raw samples are fed block by block as they arrive, all filters are causal and recursive,
+so that the work per sample is constant (independent of the recording length)
+"""
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+from scipy import signal
+from collections import deque
+import heapq
+
+from NSI import functions
+from NSI.quantiles import KLL_Sketch
+
+
+class CausalGaussian:
+    """
+    cascade of "order" one-pole low-pass filters (unit DC gain) along the last axis:
+    causal approximation of a gaussian kernel of standard deviation sigma,
+    with a group delay of sqrt(order)*sigma (the filter state is kept between calls)
+
+    the filter starts in the steady state of the first sample (no transient from zero),
+    empty blocks leave it unchanged
+    """
+
+    def __init__(self, sigma, dt, order=4):
+        self.order, self.delay = order, np.sqrt(order)*sigma
+        self.a = np.exp(-dt/(sigma/np.sqrt(order)))
+        self.zi = None
+
+    def __call__(self, x):
+        if x.shape[-1]==0:
+            return x
+        if self.zi is None:
+            self.zi = [signal.lfilter_zi([1-self.a], [1, -self.a])*x[...,:1] for k in range(self.order)]
+        for k in range(self.order):
+            x, self.zi[k] = signal.lfilter([1-self.a], [1, -self.a], x, axis=-1, zi=self.zi[k])
+        return x
+
+
+class Demodulated_Morlet:
+    """
+    causal counterpart of the (normalized) Morlet wavelet transform at frequency f:
+    the signal is detrended, demodulated at f and low-pass filtered with a causal gaussian
+    of the width of the Morlet envelope (see functions.Morlet_Envelope_Std),
+    so that a sinusoid of amplitude A gives an envelope of amplitude A
+    """
+
+    def __init__(self, f, dt, w0=6., order=4):
+        self.f, self.dt = f, dt
+        # detrending over the time scale of the wavelet (as the sliding mean of my_cwt)
+        self.trend = CausalGaussian(functions.Morlet_Wavelet_Decay(f, w0=w0), dt, order=1)
+        self.lowpass = CausalGaussian(functions.Morlet_Envelope_Std(f, w0=w0), dt, order=order)
+        self.delay = self.lowpass.delay
+
+    def __call__(self, x, n0):
+        """envelope of the block x, whose first sample is the n0-th sample of the recording"""
+        phase = np.mod(self.f*self.dt*(n0+np.arange(x.shape[-1])), 1.)
+        return 2.*np.abs(self.lowpass((x-self.trend(x))*np.exp(-2j*np.pi*phase)))
+
+
+class Sliding_Percentile:
+    """
+    percentile (as np.percentile, linear interpolation) of the last "window" values,
+    in O(log(window)) per value: the values up to the percentile rank are in a max-heap,
+    the other ones in a min-heap, the values leaving the window are deleted lazily
+    """
+
+    def __init__(self, window, percentile):
+        self.window, self.q = int(window), percentile/100.
+        self.values = deque() # (value, index) in the window
+        self.low, self.high = [], [] # heaps of (-value, -index) and (value, index)
+        self.n_low, self.n_high = 0, 0 # values of the window in each heap
+        self.deleted, self.index = set(), 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def top(self, heap):
+        # largest entry of the low heap or smallest entry of the high heap, as (value, index)
+        while (len(heap)>0) and (abs(heap[0][1]) in self.deleted):
+            self.deleted.discard(abs(heapq.heappop(heap)[1]))
+        if len(heap)==0:
+            return None
+        return (-heap[0][0], -heap[0][1]) if heap is self.low else heap[0]
+
+    def push(self, entry, low):
+        if low:
+            heapq.heappush(self.low, (-entry[0], -entry[1]))
+            self.n_low += 1
+        else:
+            heapq.heappush(self.high, entry)
+            self.n_high += 1
+
+    def append(self, value):
+        entry = (value, self.index)
+        self.index += 1
+        self.values.append(entry)
+        if len(self.values)>self.window: # the oldest value leaves the window
+            old = self.values.popleft()
+            top = self.top(self.low)
+            if (top is not None) and (old<=top):
+                self.n_low -= 1
+            else:
+                self.n_high -= 1
+            self.deleted.add(old[1])
+        top = self.top(self.low)
+        self.push(entry, (top is not None) and (entry<=top))
+        # the low heap holds the values up to the percentile rank
+        target = int(np.floor(self.q*(len(self.values)-1)))+1
+        while self.n_low>target:
+            self.push(self.top(self.low), False)
+            heapq.heappop(self.low)
+            self.n_low -= 1
+        while self.n_low<target:
+            self.push(self.top(self.high), True)
+            heapq.heappop(self.high)
+            self.n_high -= 1
+        # the deleted entries buried in the heaps are purged from time to time
+        if len(self.low)+len(self.high)>2*len(self.values)+16:
+            self.low = [e for e in self.low if -e[1] not in self.deleted]
+            self.high = [e for e in self.high if e[1] not in self.deleted]
+            heapq.heapify(self.low)
+            heapq.heapify(self.high)
+            self.deleted = set()
+
+    def percentile(self):
+        if len(self.values)==0:
+            return np.nan
+        rank = self.q*(len(self.values)-1)
+        value, fraction = self.top(self.low)[0], rank-np.floor(rank)
+        if (fraction>0) and (self.n_high>0):
+            value += (self.top(self.high)[0]-value)*fraction
+        return value
+
+
+class Online_NSI:
+    """
+    use:
+
+    online = Online_NSI(dt=1e-4)
+    for block in acquisition: # raw samples as they arrive
+        output = online.process(block)
+        if output['NSI_validated'].any(): [...] # trigger on validated states
+
+    the parameters are the ones of preprocess_LFP and compute_Network_State_Index,
+    p0 is estimated from the pLFP of the last "p0_window" seconds (see Sliding_Percentile, O(log(window))
+    per sample), or from the whole pLFP history if p0_window=None (streaming quantile sketch, see
+    quantiles.KLL_Sketch), it is updated every "p0_update" seconds,
+    no NSI is emitted (NaN) before "p0_warmup" seconds of pLFP (after the initial transient of the filters)
+    and no validation before the validation window is filled with NSI values
+
+    see "latency" for the delays of the estimates with respect to the signal
+    """
+
+    def __init__(self, dt,
+                 freqs = np.linspace(50, 300, 5),
+                 new_dt = 5e-3,
+                 gain=1.,
+                 smoothing=42e-3,
+                 percentile_for_p0=0.01,
+                 p0_window=60.,
+                 p0_update=1.,
+                 p0_warmup=5.,
+                 low_freqs = np.linspace(2,4,5),
+                 T_sliding_mean=0.5,
+                 alpha=2.85,
+                 Tstate=200e-3,
+                 w0=6.,
+                 order=4):
+
+        self.dt, self.new_dt, self.gain, self.alpha = dt, new_dt, gain, alpha
+        self.isubsmpl = int(new_dt/dt)
+        self.percentile_for_p0 = percentile_for_p0
+
+        # pLFP filters
+        self.wavelets = [Demodulated_Morlet(f, dt, w0=w0, order=order) for f in freqs]
+        self.smoothing = CausalGaussian(smoothing, new_dt, order=order)
+        # NSI filters
+        self.low_wavelets = [Demodulated_Morlet(f, new_dt, w0=w0, order=order) for f in low_freqs]
+        self.sliding_mean = CausalGaussian(T_sliding_mean, new_dt, order=order)
+
+        # validation: running max/min of the NSI over the last 2*iTstate samples (monotonic queues)
+        self.iTstate = int(Tstate/new_dt)
+        self.NSI_history = deque(maxlen=2*self.iTstate)
+        self.max_queue, self.min_queue = deque(), deque()
+        self.n_validation = 0
+
+        # p0 estimate
+        if p0_window is None:
+            self.p0_sketch, self.pLFP_history = KLL_Sketch(), [] # samples not added to the sketch yet
+        else:
+            self.p0_sketch, self.pLFP_history = None, Sliding_Percentile(int(p0_window/new_dt), percentile_for_p0)
+        self.ip0_update, self.ip0_warmup = max([1, int(p0_update/new_dt)]), int(p0_warmup/new_dt)
+        self.p0, self.n_p0 = np.nan, 0
+        self.ip0_transient = int(self.latency()['pLFP']/new_dt) # pLFP samples discarded for p0
+
+        self.n_samples, self.n_new_samples = 0, 0
+        self.remainder = np.zeros(0) # samples of an incomplete subsampling block
+
+    def latency(self):
+        """
+        delays (in s) of the estimates with respect to the signal they reflect
+        """
+        pLFP = max([w.delay for w in self.wavelets])+0.5*self.new_dt+self.smoothing.delay
+        NSI = pLFP+max([self.sliding_mean.delay]+[w.delay for w in self.low_wavelets])
+        return {'pLFP':pLFP, 'NSI':NSI, 'validation':NSI+self.iTstate*self.new_dt}
+
+    def process(self, block):
+        """
+        feeds a block of raw samples, returns the new estimates (at the new_dt resolution):
+        - 'new_t', 'pLFP', 'NSI': times and values of the new pLFP and NSI samples
+        - 't_validation', 'NSI_validated': times and validation flags of the states
+          whose [t-Tstate, t+Tstate[ window just got complete (delayed by Tstate)
+        """
+        # mean envelope of the high-gamma wavelets
+        x = self.gain*np.asarray(block, dtype=float).flatten()
+        W2 = np.zeros(len(x))
+        for wavelet in self.wavelets:
+            W2 += wavelet(x, self.n_samples)/len(self.wavelets)
+        self.n_samples += len(x)
+
+        # subsampling (by blocks, the remainder is kept for the next call)
+        W2 = np.concatenate([self.remainder, W2])
+        n = int(len(W2)/self.isubsmpl)
+        self.remainder = W2[n*self.isubsmpl:]
+        pLFP = self.smoothing(functions.block_mean(W2, self.isubsmpl))
+        new_t = (self.n_new_samples+np.arange(n))*self.new_dt
+        self.n_new_samples += n
+
+        # low frequency power and sliding mean
+        max_low_freqs_power = np.zeros(n)
+        for wavelet in self.low_wavelets:
+            max_low_freqs_power = np.maximum(max_low_freqs_power, wavelet(pLFP, self.n_new_samples-n))
+        sliding_mean = self.sliding_mean(pLFP)
+
+        # NSI (with the running p0 estimate)
+        p0 = np.array([self.update_p0(value) for value in pLFP])
+        NSI = functions.Network_State_Index({'pLFP':pLFP,
+                                             'max_low_freqs_power':max_low_freqs_power,
+                                             'sliding_mean':sliding_mean},
+                                            p0=p0, alpha=self.alpha)
+
+        # validation
+        t_validation, NSI_validated = [], []
+        for i, value in enumerate(NSI):
+            validated = self.update_validation(value)
+            if validated is not None:
+                t_validation.append(new_t[i]-(self.iTstate-1)*self.new_dt)
+                NSI_validated.append(validated)
+
+        return {'new_t':new_t, 'pLFP':pLFP, 'NSI':NSI,
+                't_validation':np.array(t_validation), 'NSI_validated':np.array(NSI_validated, dtype=bool)}
+
+    def update_p0(self, pLFP):
+        """adds a pLFP sample, returns the current p0 estimate"""
+        self.n_p0 += 1
+        if self.n_p0<=self.ip0_transient: # initial transient of the filters
+            return self.p0
+        self.pLFP_history.append(pLFP)
+        if self.p0_sketch is not None:
+            if ((self.p0_sketch.n+len(self.pLFP_history))>=self.ip0_warmup) and\
+               (np.isnan(self.p0) or (self.n_p0%self.ip0_update==0)):
+                self.p0_sketch.update(self.pLFP_history)
+                self.pLFP_history = []
+                self.p0 = self.p0_sketch.percentile(self.percentile_for_p0)
+        elif (len(self.pLFP_history)>=self.ip0_warmup) and\
+             (np.isnan(self.p0) or (self.n_p0%self.ip0_update==0)):
+            self.p0 = self.pLFP_history.percentile()
+        return self.p0
+
+    def update_validation(self, value):
+        """
+        adds a NSI sample, returns the validation of the state at the center of the
+        last 2*iTstate samples (or None if the window is not complete yet),
+        the NaN values of the warm-up (no p0 estimate yet) are skipped
+        """
+        if np.isnan(value):
+            return None
+        self.NSI_history.append(value)
+        index = self.n_validation
+        self.n_validation += 1
+        while (len(self.max_queue)>0) and (self.max_queue[-1][1]<=value):
+            self.max_queue.pop()
+        self.max_queue.append((index, value))
+        while (len(self.min_queue)>0) and (self.min_queue[-1][1]>=value):
+            self.min_queue.pop()
+        self.min_queue.append((index, value))
+        for queue in [self.max_queue, self.min_queue]:
+            while queue[0][0]<=index-2*self.iTstate:
+                queue.popleft()
+        if len(self.NSI_history)<self.NSI_history.maxlen:
+            return None
+        center = self.NSI_history[self.iTstate]
+        return bool(((self.max_queue[0][1]-center)<=self.p0) and ((center-self.min_queue[0][1])<=self.p0))
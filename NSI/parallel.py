@@ -0,0 +1,159 @@
+"""
+Multi-channel NSI analysis over a process pool, without pickling the channel arrays:
+
+- the input traces are placed once in a shared memory block (or, for a file-backed np.memmap,
+  the file is mapped again by the workers), the workers attach to it without copy
+- the outputs (pLFP, NSI, masks, ...) are preallocated (channels, samples) arrays in memory-mapped
+  .npy files, each worker writes the rows of its channels in place
+
+results = shared_multichannel_Network_State_Index([data[k] for k in data['Channel_Keys']], data['dt'],
+                                                  Channel_Keys=data['Channel_Keys'], processes=8)
+"""
+import sys, os, pathlib, mmap, tempfile, shutil, inspect
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from NSI import functions
+from NSI.IO import NSI_TIMESERIES
+
+ANALYSIS_ARGS = ['freqs', 'new_dt', 'gain', 'smoothing', 'percentile_for_p0', 'chunk_duration',
+                 'low_freqs', 'Tstate', 'alpha', 'T_sliding_mean', 'every_sample', 'dtype', 'smoothing_method']
+
+
+def share_input(Vext, chunk_size=int(1e7)):
+    """
+    description of the input traces that the workers can attach to (see attach_input),
+    and the shared memory block holding them (None if the traces are already a file-backed np.memmap)
+
+    Vext: 2-D (channels, samples) array, or list of 1-D channels (numpy arrays, memmaps, h5py datasets,
+    lazy channels of IO.load_formatted_data), copied chunk by chunk in the shared block
+    """
+    if isinstance(Vext, np.memmap) and isinstance(Vext.base, mmap.mmap) and Vext.flags.c_contiguous:
+        return ('memmap', Vext.filename, Vext.shape, Vext.dtype.str, Vext.offset), None
+    channels = [Vext[i] for i in range(Vext.shape[0])] if hasattr(Vext, 'shape') else list(Vext)
+    shape = (len(channels), len(channels[0]))
+    dtype = np.result_type(*[np.dtype(getattr(c, 'dtype', np.float64)) for c in channels])
+    block = shared_memory.SharedMemory(create=True, size=max([1, int(np.prod(shape))*dtype.itemsize]))
+    shared = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    for i, channel in enumerate(channels):
+        for i0 in range(0, shape[1], chunk_size):
+            shared[i, i0:i0+chunk_size] = channel[i0:i0+chunk_size]
+    del shared # no view left on the block, so that it can be closed
+    return ('shared_memory', block.name, shape, dtype.str), block
+
+def attach_input(source):
+    """(channels, samples) array of the input traces (see share_input) and the attached block (if any)"""
+    if source[0]=='memmap':
+        _, filename, shape, dtype, offset = source
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset), None
+    _, name, shape, dtype = source
+    block = shared_memory.SharedMemory(name=name) # (closed, but only unlinked by the creating process)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), block
+
+def allocate_outputs(folder, n_channels, n_samples, dtype=np.float64):
+    """preallocated (channels, samples) outputs in memory-mapped .npy files, returns their filenames"""
+    filenames = {}
+    for key in NSI_TIMESERIES+['p0']:
+        filenames[key] = os.path.join(folder, key+'.npy')
+        np.lib.format.open_memmap(filenames[key], mode='w+',
+                                  dtype=(bool if key in ['NSI_validated', 'NSI_unvalidated'] else dtype),
+                                  shape=((n_channels,) if key=='p0' else (n_channels, n_samples)))
+    return filenames
+
+def analyze_shared_channel(source, outputs, channel, key, dt, args, workers=1):
+    """
+    analysis of a single channel (executed in the worker processes):
+    reads its row of the shared input and writes its rows of the outputs
+    """
+    Vext, block = attach_input(source)
+    try:
+        data = {'dt':dt, key:Vext[channel]}
+        functions.preprocess_LFP(data, Vext_key=key, workers=workers,
+                                 **{k:args[k] for k in ['freqs', 'new_dt', 'gain', 'smoothing', 'percentile_for_p0',
+                                                        'chunk_duration', 'dtype', 'smoothing_method'] if k in args})
+        functions.compute_Network_State_Index(data, workers=workers,
+                                              **{('freqs' if k=='low_freqs' else k):args[k]\
+                                                 for k in ['low_freqs', 'Tstate', 'alpha', 'T_sliding_mean',
+                                                           'every_sample', 'dtype', 'smoothing_method'] if k in args})
+        for k, filename in outputs.items():
+            output = np.load(filename, mmap_mode='r+')
+            output[channel] = data[k]
+            output.flush()
+            del output
+    finally:
+        del Vext
+        if block is not None:
+            block.close()
+    return channel
+
+def shared_multichannel_Network_State_Index(Vext, dt,
+                                            Channel_Keys=None,
+                                            processes=None,
+                                            workers=1,
+                                            output_folder=None,
+                                            **args):
+    """
+    same analysis and results than functions.multichannel_Network_State_Index (same arguments, see ANALYSIS_ARGS),
+    with the channels distributed over "processes" processes (of "workers" threads each)
+
+    the arrays of the results are rows of the (channels, samples) outputs, memory-mapped from the
+    [key].npy files of output_folder (kept), or of a temporary folder (removed, the mapping stays valid)
+    """
+    for k in args:
+        if k not in ANALYSIS_ARGS:
+            raise TypeError('Unknown argument: %s' % k)
+    defaults = {k:v.default for k, v in inspect.signature(functions.multichannel_Network_State_Index).parameters.items()}
+    params = {k:args.get(k, defaults[k]) for k in ANALYSIS_ARGS}
+    n_channels = Vext.shape[0] if hasattr(Vext, 'shape') else len(Vext)
+    if Channel_Keys is None:
+        Channel_Keys = ['Channel-%i' % (i+1) for i in range(n_channels)]
+    N = Vext.shape[-1] if hasattr(Vext, 'shape') else len(Vext[0])
+    n_samples = int(N/int(params['new_dt']/dt)) # length of the subsampled outputs (see functions.block_mean)
+
+    folder = output_folder if output_folder is not None else\
+        tempfile.mkdtemp(dir=('/dev/shm' if os.path.isdir('/dev/shm') else None)) # RAM-backed if possible
+    os.makedirs(folder, exist_ok=True)
+    source, block = share_input(Vext)
+    try:
+        filenames = allocate_outputs(folder, n_channels, n_samples, dtype=params['dtype'])
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(analyze_shared_channel, source, filenames, i, key, dt, params, workers)\
+                       for i, key in enumerate(Channel_Keys)]
+            for future in futures:
+                future.result() # raises the exceptions of the workers
+        outputs = {k:np.load(filename, mmap_mode='r+') for k, filename in filenames.items()}
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+        if output_folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    new_t = np.arange(n_samples)*params['new_dt']
+    results = {}
+    for i, key in enumerate(Channel_Keys):
+        results[key] = {'dt':dt, 'pLFP_freqs':params['freqs'], 'new_dt':params['new_dt'], 'new_t':new_t,
+                        'p0':np.dtype(params['dtype']).type(outputs['p0'][i]), 'low_freqs':params['low_freqs']}
+        for k in NSI_TIMESERIES:
+            results[key][k] = outputs[k][i]
+        results[key]['t_validated'] = new_t[results[key]['NSI_validated']]
+        results[key]['i_validated'] = np.flatnonzero(results[key]['NSI_validated'])
+    return results
+
+
+if __name__=='__main__':
+
+    # regression check: same results than the in-process multichannel analysis
+    from NSI.benchmark import synthetic_LFP
+    data, _ = synthetic_LFP(duration=60., n_channels=4)
+    channels = [data[k] for k in data['Channel_Keys']]
+    reference = functions.multichannel_Network_State_Index(np.array(channels), data['dt'],
+                                                           Channel_Keys=data['Channel_Keys'])
+    results = shared_multichannel_Network_State_Index(channels, data['dt'],
+                                                      Channel_Keys=data['Channel_Keys'], processes=2)
+    for key in data['Channel_Keys']:
+        for k in NSI_TIMESERIES+['p0']:
+            assert np.allclose(results[key][k], reference[key][k], rtol=1e-6, atol=1e-9), (key, k)
+    print('%i channels: same results than multichannel_Network_State_Index' % len(results))
@@ -0,0 +1,152 @@
+"""
+Staged NSI analysis: pLFP --> sliding mean and low-freq power --> NSI --> validation --> epochs
+
+each stage records the parameters it was computed with,
+so that only the stages whose parameters changed (and their downstream stages) are recomputed
+"""
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+
+from NSI import functions
+from NSI.epochs import network_state_epochs
+
+STAGES = ['pLFP', 'low_freqs_and_mean', 'NSI', 'validation', 'epochs']
+
+def hashable(value):
+    """parameter values as comparable (and printable) objects"""
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return tuple(float(v) for v in np.asarray(value).flatten())
+    elif isinstance(value, type):
+        return np.dtype(value).str
+    else:
+        return value
+
+
+class NSI_Pipeline:
+    """
+    use:
+
+    pipeline = NSI_Pipeline(data)
+    pipeline.run(Vext_key='Extra', alpha=2.85) # full analysis
+    pipeline.run(Vext_key='Extra', alpha=3.) # only the NSI and its validation are recomputed
+    """
+
+    def __init__(self, data, cache=None, dtype=np.float64, chunk_duration=None, workers=1):
+        """
+        data: "data" dictionary (see IO.load_formatted_data), updated in place
+        cache: optional pLFP cache (see cache.pLFP_Cache)
+        chunk_duration: if given, the pLFP is computed chunk by chunk (see functions.preprocess_LFP)
+        workers: number of threads of the wavelet transforms (see functions.my_cwt_envelope)
+        """
+        self.data, self.cache, self.dtype = data, cache, dtype
+        self.chunk_duration, self.workers = chunk_duration, workers
+        self.stage_params = {stage:None for stage in STAGES}
+        self.computed = [] # stages recomputed during the last run
+
+    def invalidate(self, stage='pLFP'):
+        """forces the recomputation of "stage" and of the downstream stages"""
+        for s in STAGES[STAGES.index(stage):]:
+            self.stage_params[s] = None
+
+    def run(self,
+            Vext_key='Extra',
+            gain=1.,
+            freqs = np.linspace(50, 300, 5),
+            new_dt = 5e-3,
+            smoothing=42e-3,
+            percentile_for_p0=0.01,
+            low_freqs = np.linspace(2,4,5),
+            T_sliding_mean=0.5,
+            multirate=False,
+            smoothing_method='fir',
+            alpha=2.85,
+            Tstate=200e-3,
+            every_sample=False,
+            progress=None,
+            on_chunk=None):
+        """
+        runs the stages whose parameters differ from the ones of the previous run
+        (same arguments than preprocess_LFP and compute_Network_State_Index)
+
+        progress: optional callback, called as progress(fraction, message) within each stage,
+        it can interrupt the run by raising functions.Analysis_Cancelled
+        (the interrupted stage is then recomputed at the next run)
+        on_chunk: optional callback of the chunked pLFP computation (see functions.preprocess_LFP)
+        """
+        stages = [('pLFP', {'Vext_key':Vext_key, 'dt':self.data['dt'], 'gain':gain, 'freqs':freqs,
+                            'new_dt':new_dt, 'smoothing':smoothing, 'percentile_for_p0':percentile_for_p0,
+                            'smoothing_method':smoothing_method},
+                   self.compute_pLFP),
+                  ('low_freqs_and_mean', {'low_freqs':low_freqs, 'T_sliding_mean':T_sliding_mean,
+                                          'multirate':multirate, 'smoothing_method':smoothing_method},
+                   self.compute_low_freqs_and_mean),
+                  ('NSI', {'alpha':alpha},
+                   self.compute_NSI),
+                  ('validation', {'Tstate':Tstate, 'every_sample':every_sample},
+                   self.validate),
+                  ('epochs', {},
+                   self.compute_epochs)]
+
+        self.computed, invalid = [], False
+        for stage, params, func in stages:
+            key = {k:hashable(v) for k, v in params.items()}
+            if invalid or (self.stage_params[stage]!=key):
+                if progress is not None:
+                    progress(0., stage)
+                    callbacks = {'progress':(lambda f, m, stage=stage: progress(f, stage+': '+m))}
+                else:
+                    callbacks = {'progress':None}
+                if stage=='pLFP':
+                    callbacks['on_chunk'] = on_chunk
+                try:
+                    func(**params, **callbacks)
+                except BaseException:
+                    self.invalidate(stage) # the data of this stage can be partially updated
+                    raise
+                self.stage_params[stage] = key
+                self.computed.append(stage)
+                invalid = True # all downstream stages need to be recomputed
+        return self.computed
+
+    def compute_pLFP(self, Vext_key='Extra', dt=None, **args): # "args" include the callbacks
+        (functions.preprocess_LFP if self.cache is None else self.cache.preprocess_LFP)(self.data,
+                                                                                         Vext_key=Vext_key,
+                                                                                         dtype=self.dtype,
+                                                                                         chunk_duration=self.chunk_duration,
+                                                                                         workers=self.workers,
+                                                                                         **args)
+
+    def compute_low_freqs_and_mean(self, low_freqs=np.linspace(2,4,5), T_sliding_mean=0.5, multirate=False,
+                                   smoothing_method='fir', progress=None):
+        functions.compute_low_freqs_and_mean(self.data,
+                                             freqs=low_freqs,
+                                             T_sliding_mean=T_sliding_mean,
+                                             multirate=multirate,
+                                             smoothing_method=smoothing_method,
+                                             dtype=self.dtype,
+                                             progress=progress,
+                                             workers=self.workers)
+
+    def compute_NSI(self, alpha=2.85, progress=None):
+        self.data['NSI'] = functions.Network_State_Index(self.data,
+                                                         p0=np.dtype(self.dtype).type(self.data['p0']),
+                                                         alpha=alpha)
+
+    def validate(self, Tstate=200e-3, every_sample=False, progress=None):
+        functions.Validate_Network_States(self.data,
+                                          Tstate=Tstate,
+                                          Var_criteria=self.data['p0'],
+                                          every_sample=every_sample,
+                                          dtype=self.dtype)
+
+    def compute_epochs(self, progress=None):
+        self.data['epochs'] = network_state_epochs(self.data)
+
+    def run_with_params(self, Vext_key, params=functions.DEFAULT_VALUES, progress=None, on_chunk=None):
+        """
+        run with the GUI parameters (see functions.arguments_from_params)
+        """
+        pLFP_args, NSI_args = functions.arguments_from_params(params)
+        return self.run(Vext_key=Vext_key, gain=self.data['gain'], progress=progress, on_chunk=on_chunk,
+                        **pLFP_args, **NSI_args)
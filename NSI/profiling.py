@@ -0,0 +1,127 @@
+"""
+Stage-level profiling of the analysis: wall time, CPU time and (optionally) memory allocations
+
+the analysis functions mark their stages with:
+
+with profiling.stage('smoothing'):
+    [...]
+
+which does nothing unless a Profiler is active:
+
+with profiling.Profiler(memory=True) as profiler:
+    functions.preprocess_LFP(data)
+print(profiler.summary())
+"""
+import time, tracemalloc, contextlib, functools
+
+ACTIVE = None # active profiler (None when profiling is disabled)
+NO_PROFILING = contextlib.nullcontext() # shared no-op context, so that disabled stages cost a lookup
+
+def stage(name):
+    """context manager recording the stage "name" in the active profiler (if any)"""
+    if ACTIVE is None:
+        return NO_PROFILING
+    return ACTIVE.stage(name)
+
+def profiled(name):
+    """decorator recording each call of a function as the stage "name" """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if ACTIVE is None:
+                return func(*args, **kwargs)
+            with ACTIVE.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """
+    records the stages executed while it is active (as a context manager),
+    the stages executed several times (e.g. per chunk) are accumulated
+
+    memory=True traces the allocations with tracemalloc (slower):
+    for each stage, the peak of the allocated memory above its start level
+    and the memory still allocated at its end
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = {} # name --> accumulated record
+        self.stack = [] # stages being executed
+        self.previous = None
+
+    def __enter__(self):
+        global ACTIVE
+        self.previous, ACTIVE = ACTIVE, self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        else:
+            self.started_tracing = False
+        self.tstart, self.cpu_start = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        global ACTIVE
+        self.wall_time = time.perf_counter()-self.tstart
+        self.cpu_time = time.process_time()-self.cpu_start
+        if self.started_tracing:
+            tracemalloc.stop()
+        ACTIVE = self.previous
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # nested stages are named after their parents: "parent/child"
+        name = '/'.join([frame['name'] for frame in self.stack]+[name])
+        frame = {'name':name.split('/')[-1], 'peak':0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self.stack)>0: # the peak of the parent stage before the reset
+                self.stack[-1]['peak'] = max([self.stack[-1]['peak'], peak])
+            tracemalloc.reset_peak()
+            frame['start'] = current
+        self.stack.append(frame)
+        record = self.stages.setdefault(name, {'calls':0, 'wall_time':0., 'cpu_time':0.,
+                                               'peak_allocated_MB':0., 'retained_MB':0.})
+        tstart, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu_time = time.perf_counter()-tstart, time.process_time()-cpu_start
+            self.stack.pop()
+            record['calls'] += 1
+            record['wall_time'] += wall_time
+            record['cpu_time'] += cpu_time
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max([peak, frame['peak']])
+                record['peak_allocated_MB'] = max([record['peak_allocated_MB'], 1e-6*(peak-frame['start'])])
+                record['retained_MB'] += 1e-6*(current-frame['start'])
+                if len(self.stack)>0:
+                    self.stack[-1]['peak'] = max([self.stack[-1]['peak'], peak])
+
+    def report(self):
+        """structured report: total times and per-stage records (in execution order)"""
+        report = {'wall_time':getattr(self, 'wall_time', time.perf_counter()-self.tstart),
+                  'cpu_time':getattr(self, 'cpu_time', time.process_time()-self.cpu_start),
+                  'memory':self.memory,
+                  'stages':[dict(stage=name, **record) for name, record in self.stages.items()]}
+        return report
+
+    def summary(self):
+        """report as a printable table"""
+        return summary(self.report())
+
+
+def summary(report):
+    """profiling report (see Profiler.report) as a printable table"""
+    lines = ['%-45s %6s %10s %10s %12s' % ('stage', 'calls', 'wall (s)', 'cpu (s)', 'peak (MB)')]
+    for record in report['stages']:
+        lines.append('%-45s %6i %10.3f %10.3f %12s' % (record['stage'], record['calls'],
+                                                      record['wall_time'], record['cpu_time'],
+                                                      ('%.1f' % record['peak_allocated_MB']) if report['memory'] else '-'))
+    lines.append('%-45s %6s %10.3f %10.3f' % ('total', '', report['wall_time'], report['cpu_time']))
+    return '\n'.join(lines)
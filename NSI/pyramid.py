@@ -0,0 +1,122 @@
+"""
+Multi-resolution min/max envelopes of long signals, for plotting
+
+level k stores the min and max of bins of base*factor**k samples,
+a time window is rendered from the coarsest level that still has enough bins,
+so that the cost of a redraw does not depend on the recording length (and spikes are not aliased away)
+"""
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+
+
+def minmax_bins(mins, maxs, binsize):
+    """min and max over consecutive bins of "binsize" samples (the last bin can be incomplete)"""
+    n = int(len(mins)/binsize)*binsize
+    new_mins, new_maxs = mins[:n].reshape(-1, binsize).min(axis=1), maxs[:n].reshape(-1, binsize).max(axis=1)
+    if n<len(mins):
+        new_mins = np.append(new_mins, np.min(mins[n:]))
+        new_maxs = np.append(new_maxs, np.max(maxs[n:]))
+    return new_mins, new_maxs
+
+
+class MinMax_Pyramid:
+    """
+    use:
+
+    pyramid = MinMax_Pyramid(data['Extra'], data['dt'])
+    t, y = pyramid.window(t0, t1, Nplot=2000) # ~Nplot points (alternating bin minima and maxima)
+    """
+
+    def __init__(self, signal, dt, base=64, factor=4, chunk_size=int(1e6), levels=None):
+        """
+        signal: 1-D array (also memmaps, h5py datasets and lazy channels, read chunk by chunk),
+        it is kept to render the windows finer than the first level
+        levels: previously computed levels (see to_dict and from_dict)
+        """
+        self.signal, self.dt, self.n = signal, dt, len(signal)
+        self.base, self.factor = int(base), int(factor)
+        if levels is None:
+            self.levels = self.build(chunk_size=int(chunk_size/self.base)*self.base)
+        else:
+            self.levels = levels
+
+    def build(self, chunk_size=int(1e6)):
+        # first level, chunk by chunk (chunks are multiples of the bin size)
+        mins, maxs = [], []
+        for i0 in range(0, self.n, chunk_size):
+            x = np.asarray(self.signal[i0:i0+chunk_size])
+            chunk_mins, chunk_maxs = minmax_bins(x, x, self.base)
+            mins.append(chunk_mins)
+            maxs.append(chunk_maxs)
+        levels = [(np.concatenate(mins), np.concatenate(maxs))] if self.n>0 else []
+        # coarser levels, down to a single bin
+        while (len(levels)>0) and (len(levels[-1][0])>1):
+            levels.append(minmax_bins(*levels[-1], self.factor))
+        return levels
+
+    def binsize(self, level):
+        return self.base*self.factor**level
+
+    def window(self, t0, t1, Nplot=2000):
+        """
+        times and values to plot the signal over [t0, t1]:
+        the signal itself if it has less than Nplot samples in the window,
+        otherwise the alternating min/max of Nplot/2 bins (plotted at the start of each bin)
+        """
+        i1, i2 = max([0, int(t0/self.dt)]), min([self.n, int(t1/self.dt)])
+        if i2<=i1:
+            return np.zeros(0), np.zeros(0)
+        if (i2-i1)<=Nplot:
+            return (i1+np.arange(i2-i1))*self.dt, np.asarray(self.signal[i1:i2])
+
+        binsize = int(np.ceil((i2-i1)/max([1, int(Nplot/2)]))) # samples per plotted bin
+        # coarsest level whose bins are not larger than the plotted bins
+        level = int(np.floor(np.log(binsize/self.base)/np.log(self.factor))) if binsize>=self.base else -1
+        level = min([level, len(self.levels)-1])
+        if level<0: # finer than the first level: computed from the signal (less than base*Nplot/2 samples)
+            x = np.asarray(self.signal[i1:i2])
+            mins, maxs = minmax_bins(x, x, binsize)
+            start = i1
+        else:
+            b = self.binsize(level)
+            j1, j2 = int(i1/b), int(np.ceil(i2/b))
+            group = int(np.ceil(binsize/b)) # level bins per plotted bin
+            mins, maxs = minmax_bins(self.levels[level][0][j1:j2], self.levels[level][1][j1:j2], group)
+            binsize, start = group*b, j1*b
+
+        t = np.repeat((start+binsize*np.arange(len(mins)))*self.dt, 2)
+        y = np.empty(2*len(mins), dtype=mins.dtype)
+        y[::2], y[1::2] = mins, maxs
+        return t, y
+
+    def to_dict(self):
+        """levels as a dictionary of arrays (see IO.save_dict_to_hdf5)"""
+        levels = {'dt':float(self.dt), 'n':np.int64(self.n), 'base':np.int64(self.base), 'factor':np.int64(self.factor)}
+        for k, (mins, maxs) in enumerate(self.levels):
+            levels['mins_%i' % k], levels['maxs_%i' % k] = mins, maxs
+        return levels
+
+    @classmethod
+    def from_dict(cls, signal, levels):
+        """pyramid of "signal" from its stored levels (see to_dict)"""
+        k, stored = 0, []
+        while ('mins_%i' % k) in levels:
+            stored.append((np.asarray(levels['mins_%i' % k]), np.asarray(levels['maxs_%i' % k])))
+            k += 1
+        return cls(signal, float(levels['dt']), base=int(levels['base']), factor=int(levels['factor']), levels=stored)
+
+
+if __name__=='__main__':
+
+    # regression check: the rendered envelope matches the min/max of the signal over each window
+    signal = np.random.randn(int(3e6))
+    signal[1234567] = 50. # a single "spike" that plain subsampling would miss
+    pyramid = MinMax_Pyramid(signal, 1e-4)
+    for t0, t1 in [(0, 300), (100., 200.), (123.4, 123.5), (123.45, 123.46), (10., 10.05)]:
+        t, y = pyramid.window(t0, t1)
+        i1, i2 = int(t0/1e-4), int(t1/1e-4)
+        # (the bins at the borders of the window can include a few samples outside of it)
+        assert (y.max()>=signal[i1:i2].max()) and (y.min()<=signal[i1:i2].min())
+        assert len(y)<=2004
+        print('[%.2f, %.2f]: %i points, max=%.2f' % (t0, t1, len(y), y.max()))
@@ -0,0 +1,166 @@
+"""
+Streaming quantile estimation (KLL sketch, Karnin, Lang & Liberty 2016), used for p0
+
+the sketch is fed block by block (chunks, appended recordings, online samples) in bounded memory,
+sketches of different chunks, channels or sessions can be merged,
+and any percentile can be queried
+
+the lowest values are also kept exactly, so that the low percentiles used for p0 are exact
+"""
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import numpy as np
+
+
+class KLL_Sketch:
+    """
+    use:
+
+    sketch = KLL_Sketch()
+    for chunk in chunks:
+        sketch.update(chunk)
+    p0 = sketch.percentile(1.)
+
+    the items of level h stand for 2**h samples; a level exceeding its capacity is sorted and
+    every other item (random offset) is promoted to the next level
+
+    rank error: with k=1000, the returned percentile is within ~0.1% of the samples (in absolute rank)
+    of the exact one (see check_sketch), for a memory of ~3k items whatever the number of samples;
+    this is too coarse for p0 (e.g. the 0.01th percentile), so the "tail" lowest samples are also
+    kept exactly: the percentiles of rank below "tail" are exact (as np.percentile),
+    e.g. the 0.01th percentile up to 1e8 samples with tail=10000
+    """
+
+    def __init__(self, k=1000, seed=0, tail=10000):
+        self.k, self.n = int(k), 0
+        self.levels = [np.zeros(0)]
+        self.rng = np.random.default_rng(seed)
+        self.tail, self.low = int(tail), np.zeros(0) # lowest samples (sorted)
+
+    def capacity(self, h):
+        return max([2, int(np.ceil(self.k*(2./3.)**(len(self.levels)-1-h)))])
+
+    def update(self, values):
+        """adds samples (NaN values are ignored)"""
+        values = np.asarray(values, dtype=float).flatten()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        self.update_low(values)
+
+    def update_low(self, values):
+        low = np.concatenate([self.low, values])
+        if len(low)>self.tail:
+            low = np.partition(low, self.tail-1)[:self.tail]
+        self.low = np.sort(low)
+
+    def compress(self):
+        h = 0
+        while h<len(self.levels):
+            if len(self.levels[h])>self.capacity(h):
+                if h+1==len(self.levels):
+                    self.levels.append(np.zeros(0))
+                items = np.sort(self.levels[h])
+                kept, items = items[:len(items)%2], items[len(items)%2:] # an odd item stays at level h
+                promoted = items[self.rng.integers(2)::2]
+                self.levels[h] = kept
+                self.levels[h+1] = np.concatenate([self.levels[h+1], promoted])
+                h = 0 # the capacities changed if a level was added
+            else:
+                h += 1
+
+    def merge(self, other):
+        """adds the samples summarized by another sketch (of the same k)"""
+        while len(self.levels)<len(other.levels):
+            self.levels.append(np.zeros(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self.compress()
+        self.tail = min([self.tail, other.tail]) # exact up to the smallest of the two tails
+        self.update_low(other.low)
+        return self
+
+    def items_and_weights(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.**h) for h, items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        """value at the fraction(s) q (in [0, 1]) of the samples (exact in the kept tail)"""
+        items, weights = self.items_and_weights()
+        if len(items)==0:
+            return np.nan*np.asarray(q)
+        cumulative = np.cumsum(weights)
+        ranks = np.asarray(q)*cumulative[-1]
+        values = items[np.minimum(np.searchsorted(cumulative, ranks, side='left'), len(items)-1)]
+        # exact ranks (linear interpolation, as np.percentile) within the lowest samples
+        exact_ranks = np.asarray(q)*(self.n-1)
+        exact = np.ceil(exact_ranks)<len(self.low)
+        i0 = np.clip(np.floor(exact_ranks).astype(int), 0, max([0, len(self.low)-1]))
+        i1 = np.clip(i0+1, 0, max([0, len(self.low)-1]))
+        if len(self.low)>0:
+            fraction = exact_ranks-np.floor(exact_ranks)
+            values = np.where(exact, self.low[i0]+(self.low[i1]-self.low[i0])*fraction, values)
+        return values
+
+    def percentile(self, p):
+        """value at the percentile(s) p (in [0, 100]), as np.percentile"""
+        return self.quantile(np.asarray(p)/100.)
+
+    def size(self):
+        return int(np.sum([len(items) for items in self.levels]))+len(self.low)
+
+    def to_dict(self):
+        """sketch as a dictionary of arrays (see IO.save_dict_to_hdf5)"""
+        sketch = {'k':np.int64(self.k), 'n':np.int64(self.n), 'tail':np.int64(self.tail), 'low':self.low}
+        for h, items in enumerate(self.levels):
+            sketch['level_%i' % h] = items
+        return sketch
+
+    @classmethod
+    def from_dict(cls, sketch, seed=0):
+        new = cls(k=int(sketch['k']), seed=seed, tail=int(sketch.get('tail', 0)))
+        new.low = np.asarray(sketch.get('low', np.zeros(0)), dtype=float)
+        new.n, new.levels, h = int(sketch['n']), [], 0
+        while ('level_%i' % h) in sketch:
+            new.levels.append(np.asarray(sketch['level_%i' % h], dtype=float))
+            h += 1
+        new.levels = new.levels if len(new.levels)>0 else [np.zeros(0)]
+        return new
+
+
+def sketch_of(values, k=1000, tail=10000, chunk_size=int(1e6)):
+    """sketch of an array (any sliceable array, read chunk by chunk)"""
+    sketch = KLL_Sketch(k=k, tail=tail)
+    for i0 in range(0, len(values), chunk_size):
+        sketch.update(values[i0:i0+chunk_size])
+    return sketch
+
+def check_sketch(values, percentiles=[0.01, 0.1, 1., 10., 50.], k=1000, tail=10000, n_chunks=10):
+    """
+    rank error of the sketch (fed by n_chunks chunks, then merged) with respect to the exact percentiles:
+    maximum over percentiles of |rank(estimate)-rank(exact)|/n
+    """
+    sketches = [sketch_of(chunk, k=k, tail=tail) for chunk in np.array_split(values, n_chunks)]
+    for other in sketches[1:]:
+        sketches[0].merge(other)
+    estimates = sketches[0].percentile(percentiles)
+    ranks = np.searchsorted(np.sort(values), estimates)/len(values)
+    return np.max(np.abs(ranks-np.array(percentiles)/100.))
+
+
+if __name__=='__main__':
+
+    # rank errors on a skewed distribution (as the pLFP)
+    values = np.random.lognormal(size=int(1e7))
+    for k in [200, 1000]:
+        print('k=%i, max rank error: %.2e' % (k, check_sketch(values, k=k)))
+    # the default p0 percentile (0.01) is in the exact tail
+    values = np.random.lognormal(size=int(2e6))
+    sketch = sketch_of(values)
+    assert sketch.percentile(0.01)==np.percentile(values, 0.01)
+    print('0.01th percentile: exact (rank error: %.1e without the exact tail)' %\
+          check_sketch(values, percentiles=[0.01], tail=0))
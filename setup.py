@@ -24,6 +24,9 @@ setup(
     ],
     keywords='vision physiology',
     packages=find_packages(),
+    entry_points={
+        'console_scripts': ['nsi=NSI.__main__:main']
+    },
     install_requires=[
         "pynwb",
         "pyabf",